@@ -0,0 +1,279 @@
+"""
+闸机流量压测
+模拟N台闸机发送心跳与进出扫码，统计各接口的p50/p95/p99延迟与每秒请求数，结果以JSON输出
+
+本地模式（默认）: 使用临时SQLite数据库启动服务并写入测试用户
+    python bench/gate_bench.py --devices 50 --users 500 --duration 30 --output bench_output.json
+
+远程模式: 压测已运行的服务（需提前准备用户，按ID区间指定）
+    python bench/gate_bench.py --url http://127.0.0.1:8000 --user-ids 1-500
+"""
+
+import argparse
+import asyncio
+import base64
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(sorted_values, p):
+    """最近秩百分位"""
+    if not sorted_values:
+        return None
+    index = max(
+        0, min(len(sorted_values) - 1, int(round(p / 100 * len(sorted_values))) - 1)
+    )
+    return sorted_values[index]
+
+
+class Recorder:
+    """按接口记录延迟与失败次数"""
+
+    def __init__(self):
+        self.latencies = {}
+        self.errors = {}
+
+    def add(self, name, seconds, ok=True):
+        self.latencies.setdefault(name, []).append(seconds)
+        if not ok:
+            self.errors[name] = self.errors.get(name, 0) + 1
+
+    def report(self, duration):
+        endpoints = {}
+        for name, values in sorted(self.latencies.items()):
+            values = sorted(values)
+            endpoints[name] = {
+                "count": len(values),
+                "errors": self.errors.get(name, 0),
+                "rps": round(len(values) / duration, 2),
+                "mean_ms": round(sum(values) / len(values) * 1000, 3),
+                "p50_ms": round(percentile(values, 50) * 1000, 3),
+                "p95_ms": round(percentile(values, 95) * 1000, 3),
+                "p99_ms": round(percentile(values, 99) * 1000, 3),
+                "max_ms": round(values[-1] * 1000, 3),
+            }
+        return endpoints
+
+
+async def timed_get(client, recorder, name, path, params, check=None):
+    start = time.perf_counter()
+    try:
+        response = await client.get(path, params=params)
+        data = response.json()
+        ok = response.status_code == 200 and (check is None or check(data))
+    except Exception:
+        data, ok = None, False
+    recorder.add(name, time.perf_counter() - start, ok)
+    return data if ok else None
+
+
+async def heartbeat_loop(client, recorder, serial, interval, deadline):
+    # 错开各闸机的心跳时间
+    await asyncio.sleep(random.uniform(0, interval))
+    while time.monotonic() < deadline:
+        await timed_get(
+            client,
+            recorder,
+            "getStatus",
+            "/getStatus",
+            {"Key": str(random.randint(10000, 99999)), "Serial": serial},
+        )
+        await asyncio.sleep(interval)
+
+
+async def scan(client, recorder, serial, reader, qrcode):
+    # 闸机上报的Card为二维码内容的base64编码
+    card = base64.b64encode(qrcode.encode("utf-8")).decode("ascii")
+    return await timed_get(
+        client,
+        recorder,
+        "searchCardAcs:" + ("enter" if reader == 0 else "leave"),
+        "/searchCardAcs",
+        {"type": 9, "Reader": reader, "Serial": serial, "Card": card},
+        check=lambda data: data.get("AcsRes") == "1",
+    )
+
+
+async def turnstile_loop(client, recorder, serial, users, think_time, deadline):
+    """单台闸机循环: 取访客二维码 -> 进入 -> 离开"""
+    while time.monotonic() < deadline:
+        user_id = await users.get()
+        try:
+            data = await timed_get(
+                client,
+                recorder,
+                "qrcode",
+                "/qrcode",
+                {"user_id": user_id, "order_id": 0},
+                check=lambda data: bool(data.get("qrcode")),
+            )
+            if data is None:
+                continue
+            qrcode = data["qrcode"]
+            if data.get("enter_at") is None:
+                await scan(client, recorder, serial, 0, qrcode)
+                await asyncio.sleep(random.uniform(0, think_time))
+            await scan(client, recorder, serial, 1, qrcode)
+            await asyncio.sleep(random.uniform(0, think_time))
+        finally:
+            users.put_nowait(user_id)
+
+
+async def seed_users(count):
+    """本地模式下建表并写入测试用户"""
+    from tortoise import Tortoise
+    from config import DB_CONFIG
+    from models import User
+
+    await Tortoise.init(config=DB_CONFIG)
+    await Tortoise.generate_schemas()
+    await User.bulk_create(
+        [User(openid=f"bench-{i}", nickname=f"bench-{i}") for i in range(count)]
+    )
+    user_ids = await User.all().values_list("id", flat=True)
+    await Tortoise.close_connections()
+    return list(user_ids)
+
+
+def start_local_server(port, workers, env):
+    process = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "main.py")],
+        cwd=ROOT,
+        env={**env, "APP_PORT": str(port), "APP_WORKERS": str(workers)},
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    for _ in range(300):
+        if process.poll() is not None:
+            raise RuntimeError("服务启动失败")
+        try:
+            if httpx.get(base_url + "/", timeout=1).status_code == 200:
+                return process, base_url
+        except httpx.HTTPError:
+            pass
+        time.sleep(0.1)
+    process.terminate()
+    raise RuntimeError("服务启动超时")
+
+
+def parse_user_ids(value):
+    start, _, end = value.partition("-")
+    return list(range(int(start), int(end or start) + 1))
+
+
+async def run(args, base_url, user_ids):
+    recorder = Recorder()
+    users = asyncio.Queue()
+    random.shuffle(user_ids)
+    for user_id in user_ids:
+        users.put_nowait(user_id)
+
+    limits = httpx.Limits(max_connections=args.devices * 2)
+    async with httpx.AsyncClient(
+        base_url=base_url, limits=limits, timeout=10
+    ) as client:
+        start = time.monotonic()
+        deadline = start + args.duration
+        tasks = []
+        for i in range(args.devices):
+            serial = f"BENCH{i:04d}"
+            tasks.append(
+                heartbeat_loop(
+                    client, recorder, serial, args.heartbeat_interval, deadline
+                )
+            )
+            tasks.append(
+                turnstile_loop(
+                    client, recorder, serial, users, args.think_time, deadline
+                )
+            )
+        await asyncio.gather(*tasks)
+        duration = time.monotonic() - start
+
+    return {
+        "config": {
+            "devices": args.devices,
+            "users": len(user_ids),
+            "duration_s": args.duration,
+            "heartbeat_interval_s": args.heartbeat_interval,
+            "think_time_s": args.think_time,
+            "workers": args.workers if not args.url else None,
+            "target": args.url or "local-sqlite",
+        },
+        "duration_s": round(duration, 3),
+        "endpoints": recorder.report(duration),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="闸机流量压测")
+    parser.add_argument("--url", help="压测已运行的服务，不指定则本地启动SQLite服务")
+    parser.add_argument("--user-ids", help="远程模式使用的用户ID区间，如 1-500")
+    parser.add_argument("--devices", type=int, default=20, help="闸机数量")
+    parser.add_argument("--users", type=int, default=200, help="本地模式写入的用户数")
+    parser.add_argument("--duration", type=float, default=20, help="压测时长（秒）")
+    parser.add_argument(
+        "--heartbeat-interval", type=float, default=1.0, help="心跳间隔（秒）"
+    )
+    parser.add_argument(
+        "--think-time", type=float, default=0.05, help="两次扫码间的最大间隔（秒）"
+    )
+    parser.add_argument("--workers", type=int, default=1, help="本地服务worker数")
+    parser.add_argument("--port", type=int, default=18000, help="本地服务端口")
+    parser.add_argument("--output", help="结果JSON输出文件")
+    args = parser.parse_args()
+
+    process = None
+    if args.url:
+        if not args.user_ids:
+            parser.error("远程模式需要指定 --user-ids")
+        base_url, user_ids = args.url.rstrip("/"), parse_user_ids(args.user_ids)
+    else:
+        workdir = tempfile.mkdtemp(prefix="gate-bench-")
+        env = {
+            **os.environ,
+            "DB_ENGINE": "sqlite",
+            "DB_FILE": os.path.join(workdir, "gate.sqlite3"),
+            "SESSION_DB_PATH": os.path.join(workdir, "session.db"),
+            "NOTIFY_DB_PATH": os.path.join(workdir, "pay_notify.db"),
+            "OFFLINE_DB_PATH": os.path.join(workdir, "offline_gate.db"),
+            "METRICS_DIR": os.path.join(workdir, "metrics"),
+            "PRESENCE_DIR": os.path.join(workdir, "presence"),
+            "EVENT_DB_PATH": os.path.join(workdir, "events.db"),
+            "LOG_PATH": os.path.join(workdir, "gate.log"),
+            "APP_DEBUG": "false",
+            # 压测闸机扫码频率高于真实闸机，放开单台闸机限流
+            "GATE_SCAN_RATE": "1000",
+            "GATE_SCAN_BURST": "1000",
+        }
+        os.environ.update(env)
+        sys.path.insert(0, ROOT)
+        user_ids = asyncio.run(seed_users(args.users))
+        process, base_url = start_local_server(args.port, args.workers, env)
+
+    try:
+        result = asyncio.run(run(args, base_url, user_ids))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait(timeout=30)
+
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
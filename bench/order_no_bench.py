@@ -0,0 +1,85 @@
+"""
+订单号生成压测
+多个进程（模拟多个worker）各自生成订单号，统计生成速度并校验格式与全局唯一性，结果以JSON输出
+
+    python bench/order_no_bench.py --processes 4 --count 1000000
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import re
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from service.orderNoService import OrderNoGenerator  # noqa: E402
+
+ORDER_NO_PATTERN = re.compile(r"^\d{24}$")
+
+
+def generate(args):
+    node_id, worker_index, count = args
+    generator = OrderNoGenerator(node_id=node_id, worker_index=worker_index)
+    start = time.perf_counter()
+    order_nos = [generator.generate() for _ in range(count)]
+    return order_nos, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="订单号生成压测")
+    parser.add_argument("--processes", type=int, default=4, help="进程（worker）数")
+    parser.add_argument("--count", type=int, default=1000000, help="每个进程生成数")
+    parser.add_argument("--nodes", type=int, default=1, help="模拟的节点数")
+    parser.add_argument("--output", help="结果JSON输出文件")
+    args = parser.parse_args()
+
+    tasks = [
+        (node_id, worker_index, args.count)
+        for node_id in range(args.nodes)
+        for worker_index in range(args.processes)
+    ]
+    with multiprocessing.get_context("spawn").Pool(len(tasks)) as pool:
+        results = pool.map(generate, tasks)
+
+    seen = set()
+    duplicates = malformed = unordered = 0
+    rates = []
+    for order_nos, elapsed in results:
+        rates.append(len(order_nos) / elapsed)
+        previous = ""
+        for order_no in order_nos:
+            if not ORDER_NO_PATTERN.match(order_no):
+                malformed += 1
+            # 同一进程内单调递增
+            if order_no <= previous:
+                unordered += 1
+            previous = order_no
+            if order_no in seen:
+                duplicates += 1
+            seen.add(order_no)
+
+    result = {
+        "processes": len(tasks),
+        "total": len(seen) + duplicates,
+        "unique": len(seen),
+        "duplicates": duplicates,
+        "malformed": malformed,
+        "unordered": unordered,
+        "per_process_per_second": round(sum(rates) / len(rates)),
+        "aggregate_per_second": round(sum(rates)),
+    }
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+    if duplicates or malformed or unordered:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+二维码内容解析压测
+对比原先的base64解码（已从tool.py删除，下面保留一份副本）与 parse_qr_payload 解析闸机上报Card的耗时，
+样本包含标准/URL安全编码的UUID与签名令牌以及格式错误的内容，结果以JSON输出
+
+    python bench/qr_payload_bench.py --count 200000
+"""
+
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+import uuid
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from service.qrPayloadService import parse_qr_payload  # noqa: E402
+from service.qrTokenService import QrTokenSigner  # noqa: E402
+
+
+def build_samples():
+    qrcode = str(uuid.uuid4()).encode()
+    token = QrTokenSigner("bench", enabled=True).sign(1, 1, 1).encode()
+    return {
+        "uuid": base64.b64encode(qrcode).decode(),
+        "uuid_urlsafe": base64.urlsafe_b64encode(qrcode).decode().rstrip("="),
+        "token": base64.b64encode(token).decode().replace("+", " "),
+        "malformed": base64.b64encode(b"not a qrcode").decode(),
+        "garbage": "%%%" + "A" * 200,
+    }
+
+
+def decode_base64(value):
+    """原 tool.decodeBase64"""
+    value = value.replace(" ", "+")
+    value = value.replace("-", "+").replace("_", "/")
+    ln = (len(value) % 4) & 0xFF
+    if ln == 2:
+        value += "=="
+    if ln == 3:
+        value += "="
+    value = base64.b64decode(value)
+    return value
+
+
+def legacy(card):
+    try:
+        return decode_base64(card).decode("utf-8")
+    except ValueError:
+        return None
+
+
+def measure(func, card, count):
+    start = time.perf_counter()
+    for _ in range(count):
+        func(card)
+    return (time.perf_counter() - start) / count * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description="二维码内容解析压测")
+    parser.add_argument("--count", type=int, default=200000, help="每种样本解析次数")
+    parser.add_argument("--output", help="结果JSON输出文件")
+    args = parser.parse_args()
+
+    result = {}
+    for name, card in build_samples().items():
+        legacy_ns = measure(legacy, card, args.count)
+        parse_ns = measure(parse_qr_payload, card, args.count)
+        result[name] = {
+            "legacy_ns": round(legacy_ns),
+            "parse_ns": round(parse_ns),
+            # 大于1表示新函数更快（新函数额外做了格式校验）
+            "ratio": round(legacy_ns / parse_ns, 2),
+            # 旧函数对格式错误的内容仍返回字符串，随后会查询数据库
+            "legacy_accepted": legacy(card) is not None,
+            "parse_accepted": parse_qr_payload(card) is not None,
+        }
+    output = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    print(output)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,8 @@
 import os
+from dotenv import load_dotenv
+
+# 加载.env文件，保证读取配置前环境变量已就绪
+load_dotenv()
 
 # 数据库配置
 DB_CONFIG = {
@@ -12,6 +16,13 @@ DB_CONFIG = {
                 "password": os.getenv("DB_PASSWORD", ""),
                 "database": os.getenv("DB_NAME", "test"),
                 "charset": "utf8mb4",
+                # 每个worker进程的连接池大小
+                "minsize": int(os.getenv("DB_POOL_MINSIZE", "5")),
+                "maxsize": int(os.getenv("DB_POOL_MAXSIZE", "20")),
+                # 建立连接超时（秒）
+                "connect_timeout": int(os.getenv("DB_CONNECT_TIMEOUT", "5")),
+                # 连接最长复用时间（秒），需小于MySQL的wait_timeout
+                "pool_recycle": int(os.getenv("DB_POOL_RECYCLE", "3600")),
             },
         }
     },
@@ -22,3 +33,246 @@ DB_CONFIG = {
         }
     },
 }
+
+# 本地压测/开发可使用SQLite代替MySQL: DB_ENGINE=sqlite
+if os.getenv("DB_ENGINE", "mysql") == "sqlite":
+    DB_CONFIG["connections"]["default"] = {
+        "engine": "tortoise.backends.sqlite",
+        "credentials": {"file_path": os.getenv("DB_FILE", "data/gate.sqlite3")},
+    }
+
+# 只读副本：配置 DB_READ_HOST 后，小程序的纯读查询走副本，闸机与写操作始终使用主库
+elif os.getenv("DB_READ_HOST"):
+    primary_credentials = DB_CONFIG["connections"]["default"]["credentials"]
+    DB_CONFIG["connections"]["read"] = {
+        "engine": "tortoise.backends.mysql",
+        "credentials": {
+            **primary_credentials,
+            "host": os.getenv("DB_READ_HOST"),
+            "port": int(os.getenv("DB_READ_PORT", str(primary_credentials["port"]))),
+            "user": os.getenv("DB_READ_USER", primary_credentials["user"]),
+            "password": os.getenv("DB_READ_PASSWORD", primary_credentials["password"]),
+            "minsize": int(os.getenv("DB_READ_POOL_MINSIZE", "2")),
+            "maxsize": int(os.getenv("DB_READ_POOL_MAXSIZE", "10")),
+        },
+    }
+
+# 读写分离
+DB_READ_CONFIG = {
+    "enabled": "read" in DB_CONFIG["connections"],
+    # 用户写入后多少秒内的读取仍走主库（需大于副本复制延迟）
+    "sticky_seconds": float(os.getenv("DB_READ_STICKY_SECONDS", "5")),
+    # 最多记录的近期写入用户数
+    "maxsize": int(os.getenv("DB_READ_STICKY_MAXSIZE", "10000")),
+}
+
+# 服务运行配置，生产环境默认按CPU核数启动多个worker并关闭debug
+SERVER_CONFIG = {
+    "host": os.getenv("APP_HOST", "0.0.0.0"),
+    "port": int(os.getenv("APP_PORT", "8000")),
+    "workers": int(os.getenv("APP_WORKERS", str(os.cpu_count() or 1))),
+    "debug": os.getenv("APP_DEBUG", "false").lower() in ("1", "true", "yes"),
+    "access_log": os.getenv("APP_ACCESS_LOG", "false").lower() in ("1", "true", "yes"),
+}
+
+# 闸机心跳配置
+HEARTBEAT_CONFIG = {
+    # 心跳批量落库间隔（秒）
+    "flush_interval": float(os.getenv("HEARTBEAT_FLUSH_INTERVAL", "10")),
+    # 单条UPDATE最多包含的设备数
+    "batch_size": int(os.getenv("HEARTBEAT_BATCH_SIZE", "500")),
+}
+
+# 微信接口客户端配置
+WECHAT_CONFIG = {
+    # 单次调用超时（秒）
+    "timeout": float(os.getenv("WECHAT_TIMEOUT", "5")),
+    # 连接池大小
+    "max_connections": int(os.getenv("WECHAT_MAX_CONNECTIONS", "50")),
+    # 同时进行的微信调用数上限
+    "max_concurrency": int(os.getenv("WECHAT_MAX_CONCURRENCY", "20")),
+    # 同步调用线程池大小
+    "thread_pool_size": int(os.getenv("WECHAT_THREAD_POOL_SIZE", "8")),
+}
+
+# 微信支付配置
+WECHAT_PAY_CONFIG = {
+    # 平台证书后台刷新间隔（秒）
+    "cert_refresh_interval": float(
+        os.getenv("WECHAT_CERT_REFRESH_INTERVAL", str(12 * 3600))
+    ),
+    # 对账使用本地模拟的订单查询与关闭（不访问微信接口），交易状态从mock_file读取；
+    # 支付下单与支付通知验签不受影响
+    "mock": os.getenv("WECHAT_MOCK", "false").lower() == "true",
+    "mock_file": os.getenv("WECHAT_MOCK_FILE", "data/wechat_mock.json"),
+}
+
+# 小程序session_key存储配置
+SESSION_CONFIG = {
+    # memory: 进程内（仅单进程） sqlite: 本地文件（多进程共享）
+    "backend": os.getenv("SESSION_STORE", "sqlite"),
+    "path": os.getenv("SESSION_DB_PATH", "data/session.db"),
+    # 过期时间（秒）
+    "ttl": float(os.getenv("SESSION_TTL", "1800")),
+    # 最多保存的session数
+    "maxsize": int(os.getenv("SESSION_MAX_SIZE", "10000")),
+}
+
+# 签名二维码令牌配置
+QR_TOKEN_CONFIG = {
+    # 是否向小程序下发签名令牌（闸机始终兼容原UUID二维码）
+    "enabled": os.getenv("QR_TOKEN_ENABLED", "false").lower() in ("1", "true", "yes"),
+    # HMAC密钥，多个worker/实例需保持一致
+    "secret": os.getenv("QR_TOKEN_SECRET", ""),
+    # 令牌有效期（秒）
+    "ttl": int(os.getenv("QR_TOKEN_TTL", "86400")),
+}
+
+# 运行指标配置
+METRICS_CONFIG = {
+    # 各worker指标快照目录
+    "dir": os.getenv("METRICS_DIR", "data/metrics"),
+    # worker指标快照写入间隔（秒），/metrics 汇总其他worker时最多延迟该时长
+    "sync_interval": float(os.getenv("METRICS_SYNC_INTERVAL", "5")),
+}
+
+# 日志配置
+LOG_CONFIG = {
+    # 多worker运行时自动追加worker名，如 gate.Sanic-Server-0-0.log
+    "path": os.getenv("LOG_PATH", "gate.log"),
+    "level": os.getenv("LOG_LEVEL", "INFO"),
+    # 按大小（字节）或时间（秒）轮转，轮转后gzip压缩，保留最近retention个
+    "rotation_bytes": int(os.getenv("LOG_ROTATION_BYTES", str(100 * 1024 * 1024))),
+    "rotation_interval": float(os.getenv("LOG_ROTATION_INTERVAL", "86400")),
+    "retention": int(os.getenv("LOG_RETENTION", "14")),
+    # 批量写入：缓冲达到batch_bytes或每flush_interval秒写一次
+    "batch_bytes": int(os.getenv("LOG_BATCH_BYTES", str(64 * 1024))),
+    "flush_interval": float(os.getenv("LOG_FLUSH_INTERVAL", "1")),
+    # 闸机错误日志限流：每rate_window秒同类最多rate_limit条
+    "rate_limit": int(os.getenv("LOG_RATE_LIMIT", "20")),
+    "rate_window": float(os.getenv("LOG_RATE_WINDOW", "1")),
+}
+
+# 支付通知队列配置
+NOTIFY_CONFIG = {
+    "path": os.getenv("NOTIFY_DB_PATH", "data/pay_notify.db"),
+    # 每个worker的处理并发数
+    "concurrency": int(os.getenv("NOTIFY_CONCURRENCY", "2")),
+    # 空闲时轮询间隔（秒）
+    "poll_interval": float(os.getenv("NOTIFY_POLL_INTERVAL", "1")),
+    # 领取后未完成的通知在lease秒后可被重新领取
+    "lease": float(os.getenv("NOTIFY_LEASE", "60")),
+    # 失败重试次数与首次重试间隔（秒，指数退避）
+    "max_attempts": int(os.getenv("NOTIFY_MAX_ATTEMPTS", "10")),
+    "retry_delay": float(os.getenv("NOTIFY_RETRY_DELAY", "2")),
+}
+
+# 离线放行（数据库超时/不可用时根据本地快照判断）
+OFFLINE_CONFIG = {
+    "path": os.getenv("OFFLINE_DB_PATH", "data/offline_gate.db"),
+    # 闸机判断的数据库延迟预算（秒），超出后改为本地判断
+    "db_budget": float(os.getenv("OFFLINE_DB_BUDGET", "0.5")),
+    # 进入离线状态后多久再尝试数据库（秒）
+    "offline_hold": float(os.getenv("OFFLINE_HOLD", "5")),
+    # 未离开二维码快照刷新间隔（秒）
+    "snapshot_interval": float(os.getenv("OFFLINE_SNAPSHOT_INTERVAL", "60")),
+    "replay_batch": int(os.getenv("OFFLINE_REPLAY_BATCH", "200")),
+}
+
+# 订单号生成
+ORDER_NO_CONFIG = {
+    # 节点号（0-99），多台服务器部署时每台需不同
+    "node_id": int(os.getenv("NODE_ID", "0")),
+}
+
+# 闸机准入索引（每个worker进程内）
+ADMISSION_INDEX_CONFIG = {
+    # 条目有效期（秒），其他worker处理的进出最多延迟该时间后回源数据库
+    "ttl": float(os.getenv("ADMISSION_INDEX_TTL", "300")),
+    "maxsize": int(os.getenv("ADMISSION_INDEX_MAXSIZE", "100000")),
+}
+
+# 用户热点行缓存（每个worker进程内）
+USER_CACHE_CONFIG = {
+    "maxsize": int(os.getenv("USER_CACHE_MAXSIZE", "10000")),
+    # 缓存有效期（秒），其他worker更新用户信息后最多延迟该时间可见
+    "ttl": float(os.getenv("USER_CACHE_TTL", "300")),
+}
+
+# /qrcode 响应缓存（每个worker进程内）
+QRCODE_CACHE_CONFIG = {
+    "maxsize": int(os.getenv("QRCODE_CACHE_MAXSIZE", "10000")),
+    # 缓存有效期（秒），闸机在其他worker处理时本worker的缓存最多延迟该时间
+    "ttl": float(os.getenv("QRCODE_CACHE_TTL", "2")),
+}
+
+# 闸机限流与降载（每个worker进程内）
+GATE_THROTTLE_CONFIG = {
+    # 单台闸机心跳与扫码的令牌桶：每秒请求数与突发上限
+    "heartbeat_rate": float(os.getenv("GATE_HEARTBEAT_RATE", "1")),
+    "heartbeat_burst": int(os.getenv("GATE_HEARTBEAT_BURST", "5")),
+    "scan_rate": float(os.getenv("GATE_SCAN_RATE", "5")),
+    "scan_burst": int(os.getenv("GATE_SCAN_BURST", "20")),
+    # 闸机接口同时访问数据库的请求数，默认与连接池大小一致
+    "db_concurrency": int(
+        os.getenv("GATE_DB_CONCURRENCY", os.getenv("DB_POOL_MAXSIZE", "20"))
+    ),
+    # 最多跟踪的设备数
+    "maxsize": int(os.getenv("GATE_THROTTLE_MAXSIZE", "10000")),
+}
+
+# 进入记录归档（执行 migrations/ 下的归档表迁移后开启）
+ARCHIVE_CONFIG = {
+    "enabled": os.getenv("ARCHIVE_ENABLED", "false").lower() == "true",
+    # 离开超过多少天的记录迁移到归档表
+    "retention_days": int(os.getenv("ARCHIVE_RETENTION_DAYS", "90")),
+    # 每批迁移条数与批次间隔（秒），避免长时间锁表
+    "batch_size": int(os.getenv("ARCHIVE_BATCH_SIZE", "500")),
+    "batch_pause": float(os.getenv("ARCHIVE_BATCH_PAUSE", "0.2")),
+    # 归档任务执行间隔（秒）
+    "interval": float(os.getenv("ARCHIVE_INTERVAL", "3600")),
+}
+
+# 在场人数与闸机在线状态
+PRESENCE_CONFIG = {
+    # 各worker增量与主进程基线的共享目录
+    "directory": os.getenv("PRESENCE_DIR", "data/presence"),
+    # 超过多少秒没有心跳视为离线
+    "stale_after": float(os.getenv("PRESENCE_STALE_AFTER", "60")),
+    # 闸机所属场地，格式: 场地:设备号,设备号;场地:设备号，未配置的闸机归入default
+    "sites": {
+        device_no: site
+        for site, _, device_nos in (
+            item.partition(":") for item in os.getenv("GATE_SITES", "").split(";")
+        )
+        for device_no in device_nos.split(",")
+        if site and device_no
+    },
+}
+
+# 付款中订单对账（支付通知丢失时按微信交易状态补处理）
+RECONCILE_CONFIG = {
+    # 需先执行订单状态索引迁移再开启
+    "enabled": os.getenv("RECONCILE_ENABLED", "false").lower() == "true",
+    # 执行间隔（秒）
+    "interval": float(os.getenv("RECONCILE_INTERVAL", "300")),
+    # 创建超过多少秒仍在付款中的订单需要对账
+    "min_age": float(os.getenv("RECONCILE_MIN_AGE", "600")),
+    # 创建超过多少秒仍未支付的订单关闭并取消（微信预支付有效期为2小时）
+    "expire_after": float(os.getenv("RECONCILE_EXPIRE_AFTER", str(2 * 3600))),
+    # 每批订单数与同时查询微信的请求数
+    "batch_size": int(os.getenv("RECONCILE_BATCH_SIZE", "100")),
+    "concurrency": int(os.getenv("RECONCILE_CONCURRENCY", "4")),
+}
+
+# 用户事件推送（WebSocket）
+EVENT_CONFIG = {
+    # 跨worker共享的事件表
+    "path": os.getenv("EVENT_DB_PATH", "data/events.db"),
+    # 读取其他worker事件的间隔（秒）
+    "poll_interval": float(os.getenv("EVENT_POLL_INTERVAL", "0.2")),
+    # 事件保留时间（秒）
+    "retention": float(os.getenv("EVENT_RETENTION", "60")),
+    # 每个连接最多缓存的未发送事件数
+    "queue_size": int(os.getenv("EVENT_QUEUE_SIZE", "100")),
+}
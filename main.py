@@ -1,22 +1,56 @@
-from tool import decodeBase64
+import asyncio
+import json
+import time
+from datetime import datetime, timedelta
+from tool import startRequestClock
 from sanic import Sanic, response
 from sanic.request import Request
 from dotenv import load_dotenv
-from tortoise import Tortoise
+from tortoise import Tortoise, connections
+from tortoise.functions import Count
 from models import User, EnterLog, Device, Order
-from config import DB_CONFIG
+from config import (
+    DB_CONFIG,
+    SERVER_CONFIG,
+    HEARTBEAT_CONFIG,
+    WECHAT_PAY_CONFIG,
+    METRICS_CONFIG,
+    LOG_CONFIG,
+    NOTIFY_CONFIG,
+    OFFLINE_CONFIG,
+    ARCHIVE_CONFIG,
+    PRESENCE_CONFIG,
+    RECONCILE_CONFIG,
+)
 from sanic.exceptions import BadRequest
+from websockets.exceptions import ConnectionClosed
 from loguru import logger
-from service.wechatService import weChatPay, weChatTool
+from service.wechatService import weChatPay, weChatTool, trade_client, wechat_client
+from service.schemaService import check_indexes
+from service.admissionService import AdmissionDenied
+from service.metricsService import metrics, shared_metrics
+from service.logService import setup_logging
+from service.notifyService import create_pay_notify_worker
+from service.offlineService import OfflineGate
+from service.throttleService import gate_throttle
+from service.presenceService import presence_tracker
+from service.eventService import event_bus
+from service.qrPayloadService import parse_qr_payload
+from service.reconcileService import PayingOrderReconciler
+from service.workerService import get_worker_index
 
 # 加载.env文件
 load_dotenv()
 
 # 设置日志配置
-logger.add("gate.log")
+setup_logging(**LOG_CONFIG)
+
+# 闸机接口日志按类型限流
+heartbeat_logger = logger.bind(rate_key="getStatus")
+scan_logger = logger.bind(rate_key="searchCardAcs")
 
 # 初始化Sanic应用
-app = Sanic(__name__)
+app = Sanic("gate")
 
 
 # 初始化数据库
@@ -26,9 +60,219 @@ async def init_db(app, loop):
     # 生成数据表（如果不存在）
     # await Tortoise.generate_schemas()
 
+    # 预热连接池，避免首批闸机请求承担建连耗时
+    await warm_db_connections()
+
+    # 检查热点查询索引
+    try:
+        features = [
+            name
+            for name, config in (
+                ("archive", ARCHIVE_CONFIG),
+                ("reconcile", RECONCILE_CONFIG),
+            )
+            if config["enabled"]
+        ]
+        missing = await check_indexes(connections.get("default"), features)
+        for table, columns, unique in missing:
+            logger.warning(
+                f"缺少{'唯一' if unique else ''}索引 {table}({', '.join(columns)})，"
+                f"请执行 migrations/ 下的迁移脚本"
+            )
+    except Exception as e:
+        logger.error(f"索引检查失败, error: {e}")
+
+    # 预热闸机准入索引
+    count = await EnterLog.warm_admission_index()
+    logger.info(f"准入索引预热完成, 未离开记录: {count}")
+
+    # 加载已知设备
+    await Device.warm_heartbeat_devices()
+
+    # worker重启时沿用此前的在场人数增量，并汇总基线与其他worker的数据
+    presence_tracker.restore()
+    presence_tracker.refresh()
+
+    # 启动微信接口客户端
+    await wechat_client.start()
+
+    # 离线放行（本地快照与离线进出日志）
+    app.ctx.offline_gate = OfflineGate(**OFFLINE_CONFIG)
+
+    # 支付通知队列
+    app.ctx.pay_notify = create_pay_notify_worker(apply_pay_notify, **NOTIFY_CONFIG)
+
+    # 付款中订单对账，已支付的订单写入支付通知队列
+    app.ctx.reconciler = PayingOrderReconciler(
+        query=lambda out_trade_no: wechat_client.run_sync(
+            lambda: trade_client().query_order(out_trade_no), call="query_order"
+        ),
+        close=lambda out_trade_no: wechat_client.run_sync(
+            lambda: trade_client().close_order(out_trade_no), call="close_order"
+        ),
+        on_paid=app.ctx.pay_notify.enqueue,
+        min_age=RECONCILE_CONFIG["min_age"],
+        expire_after=RECONCILE_CONFIG["expire_after"],
+        batch_size=RECONCILE_CONFIG["batch_size"],
+        concurrency=RECONCILE_CONFIG["concurrency"],
+    )
+
+    # 预加载微信支付客户端（密钥与平台证书），失败时在首次支付请求时重试
+    try:
+        await wechat_client.run_sync(weChatPay.instance, call="init_pay_client")
+    except Exception as e:
+        logger.error(f"微信支付客户端初始化失败, error: {e}")
+
+
+# 并发执行简单查询，使连接池（包括只读副本）建立最小连接数
+async def warm_db_connections():
+    queries = []
+    for name, connection in DB_CONFIG["connections"].items():
+        conn = connections.get(name)
+        minsize = connection["credentials"].get("minsize", 1)
+        queries.extend(conn.execute_query("SELECT 1") for _ in range(minsize))
+    await asyncio.gather(*queries)
+
+
+# 心跳定时批量落库
+async def flush_heartbeats_forever():
+    while True:
+        await asyncio.sleep(HEARTBEAT_CONFIG["flush_interval"])
+        try:
+            await Device.flush_heartbeats(HEARTBEAT_CONFIG["batch_size"])
+        except Exception as e:
+            logger.error(f"心跳落库失败, error: {e}")
+
+
+# 微信支付平台证书定时刷新
+async def refresh_wechat_certificates_forever():
+    while True:
+        await asyncio.sleep(WECHAT_PAY_CONFIG["cert_refresh_interval"])
+        try:
+            await wechat_client.run_sync(
+                lambda: weChatPay.instance().refresh_certificates(),
+                call="refresh_certificates",
+            )
+        except Exception as e:
+            logger.error(f"微信支付平台证书刷新失败, error: {e}")
+
+
+# 定时发布当前worker的指标快照，供其他worker的 /metrics 汇总
+async def publish_metrics_forever():
+    while True:
+        await asyncio.sleep(METRICS_CONFIG["sync_interval"])
+        try:
+            shared_metrics.publish()
+        except Exception as e:
+            logger.error(f"指标快照写入失败, error: {e}")
+
+
+# 定时将已离开超过保留期的进入记录分批迁移到归档表
+async def archive_enter_logs_forever():
+    while True:
+        await asyncio.sleep(ARCHIVE_CONFIG["interval"])
+        before = (
+            datetime.now() - timedelta(days=ARCHIVE_CONFIG["retention_days"])
+        ).strftime("%Y-%m-%d %H:%M:%S")
+        total = 0
+        try:
+            while True:
+                count = await EnterLog.archive_closed(
+                    before, ARCHIVE_CONFIG["batch_size"]
+                )
+                total += count
+                if count < ARCHIVE_CONFIG["batch_size"]:
+                    break
+                await asyncio.sleep(ARCHIVE_CONFIG["batch_pause"])
+        except Exception as e:
+            logger.error(f"进入记录归档失败, error: {e}")
+        if total:
+            logger.info(f"进入记录归档完成, 条数: {total}")
+
+
+# 定时发布当前worker的在场人数增量与心跳时间，并在后台重建汇总供查询使用
+async def publish_presence_forever():
+    while True:
+        await asyncio.sleep(METRICS_CONFIG["sync_interval"])
+        try:
+            await presence_tracker.sync()
+        except Exception as e:
+            logger.error(f"在场人数同步失败, error: {e}")
+
+
+@app.main_process_start
+async def clear_metrics(app, loop):
+    # 清理上次运行遗留的指标快照
+    shared_metrics.clear()
+
+
+@app.main_process_start
+async def init_presence_baseline(app, loop):
+    # worker启动前从数据库计算在场人数与设备活跃时间基线，之后只做增量统计
+    presence_tracker.clear()
+    try:
+        await Tortoise.init(config=DB_CONFIG)
+        rows = (
+            await EnterLog.filter(enter_at__isnull=False, leave_at=None)
+            .annotate(count=Count("id"))
+            .group_by("enter_device_no")
+            .values("enter_device_no", "count")
+        )
+        devices = await Device.filter(active_at__isnull=False).values_list(
+            "device_no", "active_at"
+        )
+    except Exception as e:
+        logger.error(f"在场人数基线计算失败, error: {e}")
+        return
+    finally:
+        await Tortoise.close_connections()
+
+    occupancy = {}
+    for row in rows:
+        gate = row["enter_device_no"] or "unknown"
+        occupancy[gate] = occupancy.get(gate, 0) + row["count"]
+    presence_tracker.write_baseline(
+        occupancy,
+        # 数据库中为本地时间
+        {
+            device_no: active_at.replace(tzinfo=None).timestamp()
+            for device_no, active_at in devices
+            if device_no
+        },
+    )
+
+
+@app.listener("after_server_start")
+async def start_background_tasks(app, loop):
+    app.add_task(flush_heartbeats_forever(), name="flush_heartbeats")
+    app.add_task(refresh_wechat_certificates_forever(), name="refresh_certificates")
+    app.add_task(publish_metrics_forever(), name="publish_metrics")
+    app.add_task(publish_presence_forever(), name="publish_presence")
+    app.add_task(app.ctx.pay_notify.run(), name="pay_notify")
+    app.add_task(app.ctx.offline_gate.run(), name="offline_gate")
+    # 对账只在第一个worker中执行，避免重复查询微信
+    if RECONCILE_CONFIG["enabled"] and get_worker_index() == 0:
+        app.add_task(
+            app.ctx.reconciler.run(RECONCILE_CONFIG["interval"]), name="reconcile"
+        )
+    if ARCHIVE_CONFIG["enabled"]:
+        app.add_task(archive_enter_logs_forever(), name="archive_enter_logs")
+
 
 @app.listener("after_server_stop")
 async def close_db(app, loop):
+    # 关闭前落库剩余心跳
+    try:
+        await Device.flush_heartbeats(HEARTBEAT_CONFIG["batch_size"])
+    except Exception as e:
+        logger.error(f"心跳落库失败, error: {e}")
+    try:
+        shared_metrics.publish()
+        presence_tracker.publish()
+    except Exception as e:
+        logger.error(f"指标快照写入失败, error: {e}")
+    await event_bus.close()
+    await wechat_client.close()
     await Tortoise.close_connections()
 
 
@@ -37,11 +281,39 @@ async def handle_bad_request(request, exception):
     return response.json({"code": 400, "msg": str(exception)}, status=400)
 
 
+# 记录接口耗时，并固定本次请求的写入时间
+@app.on_request
+async def start_timer(request: Request):
+    request.ctx.started_at = time.perf_counter()
+    startRequestClock()
+
+
+@app.on_response
+async def observe_request(request: Request, resp):
+    started_at = getattr(request.ctx, "started_at", None)
+    if started_at is None:
+        return
+    route = "/" + request.route.path if request.route else "unmatched"
+    metrics.observe(
+        "http_request_duration_seconds",
+        time.perf_counter() - started_at,
+        (route, request.method, str(resp.status if resp else 500)),
+    )
+
+
 @app.route("/")
 async def index(request: Request):
     return response.text("ok!")
 
 
+# 运行指标（Prometheus文本格式，汇总所有worker）
+@app.route("/metrics")
+async def metrics_endpoint(request: Request):
+    return response.text(
+        shared_metrics.render(), content_type="text/plain; version=0.0.4"
+    )
+
+
 """
 --------------------------------------------------------小程序接口
 """
@@ -56,7 +328,7 @@ async def openid(request: Request):
         raise BadRequest("缺少参数")
 
     try:
-        openid = weChatTool().get_openid(code)
+        openid = await weChatTool().get_openid(code)
         return response.json({"openid": openid})
     except Exception as e:
         logger.error(f"获取openid失败: {e}")
@@ -106,21 +378,88 @@ async def qrcode(request: Request):
     if not user_id:
         raise BadRequest("缺少参数")
 
-    enter_log = await EnterLog.get_enter_log_by_user_id(user_id, order_id)
+    # 返回记录信息（短期缓存，进出闸后失效）
+    return response.json(await EnterLog.get_qrcode_payload(user_id, order_id))
+
 
-    # 返回记录信息
+# 用户进出记录（包括已归档的历史记录），按ID倒序分页
+@app.route("/enter_history")
+async def enter_history(request: Request):
+
+    user_id = request.args.get("user_id")
+    if not user_id:
+        raise BadRequest("缺少参数")
+    try:
+        user_id = int(user_id)
+        limit = int(request.args.get("limit", 20))
+        before_id = request.args.get("before_id")
+        before_id = int(before_id) if before_id else None
+    except ValueError:
+        raise BadRequest("参数格式错误")
+    if limit < 1:
+        raise BadRequest("limit必须大于0")
+    limit = min(limit, 100)
+
+    rows = await EnterLog.get_history(user_id, limit, before_id)
     return response.json(
         {
-            "qrcode": enter_log.qrcode,
-            "enter_at": enter_log.enter_at.isoformat() if enter_log.enter_at else None,
-            "leave_at": enter_log.leave_at.isoformat() if enter_log.leave_at else None,
-            "created_at": (
-                enter_log.created_at.isoformat() if enter_log.created_at else None
-            ),
+            "items": [
+                {
+                    "id": row["id"],
+                    "order_id": row["order_id"],
+                    "enter_at": (
+                        row["enter_at"].isoformat() if row["enter_at"] else None
+                    ),
+                    "leave_at": (
+                        row["leave_at"].isoformat() if row["leave_at"] else None
+                    ),
+                    "created_at": (
+                        row["created_at"].isoformat() if row["created_at"] else None
+                    ),
+                }
+                for row in rows
+            ],
+            # 下一页的before_id，为空表示没有更多记录
+            "next_before_id": rows[-1]["id"] if rows and len(rows) == limit else None,
         }
     )
 
 
+# 用户事件推送：进出闸、支付成功时推送，代替轮询 /qrcode
+@app.websocket("/ws")
+async def user_events(request: Request, ws):
+
+    user_id = request.args.get("user_id")
+    if not user_id:
+        await ws.close(code=1008, reason="missing user_id")
+        return
+
+    queue = event_bus.subscribe(user_id)
+    # 读取客户端消息以便及时发现断开，连接关闭时 recv/send 抛出 ConnectionClosed
+    reader = asyncio.ensure_future(ws.recv())
+    getter = None
+    try:
+        while True:
+            getter = asyncio.ensure_future(queue.get())
+            done, _ = await asyncio.wait(
+                {getter, reader}, return_when=asyncio.FIRST_COMPLETED
+            )
+            if reader in done:
+                reader.result()
+                reader = asyncio.ensure_future(ws.recv())
+            if getter in done:
+                await ws.send(json.dumps(getter.result(), ensure_ascii=False))
+            else:
+                getter.cancel()
+    except ConnectionClosed:
+        pass
+    finally:
+        reader.cancel()
+        if getter is not None:
+            getter.cancel()
+        event_bus.unsubscribe(user_id, queue)
+
+
 # 查询教练订单
 @app.route("/coach_order")
 async def coach_order(request: Request):
@@ -137,7 +476,9 @@ async def coach_order(request: Request):
     if not enter_log:
         raise BadRequest("教练无入闸二维码")
 
-    return response.json({"order_id": order.id, "qrcode": enter_log.qrcode})
+    return response.json(
+        {"order_id": order.id, "qrcode": enter_log.get_display_qrcode()}
+    )
 
 
 # 预支付下单
@@ -154,7 +495,9 @@ async def pay(request: Request):
         # 创建订单
         order, user = await Order.create_order(user_id, money)
         # 预支付
-        pay_res = weChatPay().prepay(order, user.openid)
+        pay_res = await wechat_client.run_sync(
+            lambda: weChatPay.instance().prepay(order, user.openid), call="prepay"
+        )
         return response.json(pay_res)
     except Exception as e:
         logger.error(f"支付异常请稍后重试, error: {e}")
@@ -163,13 +506,30 @@ async def pay(request: Request):
         raise BadRequest(f"支付异常请稍后重试")
 
 
-# 支付结果通知
+# 处理已验签的支付通知（后台任务调用，可重复执行）
+async def apply_pay_notify(out_trade_no, transaction_id, openid):
+    # 更新订单为已支付
+    order = await Order.update_order_paid(out_trade_no, transaction_id)
+    if not order:
+        raise Exception(f"订单不存在 {out_trade_no}")
+
+    # 创建入闸机二维码
+    await EnterLog.get_enter_log_by_open_id(openid, order.id)
+    event_bus.publish(order.user_id, {"type": "paid", "order_id": order.id})
+
+
+# 支付结果通知：验签后写入持久化队列即应答，订单由后台任务处理
 @app.route("/pay_notify", methods=["POST"])
 async def pay_notify(request: Request):
 
     try:
         # 验证通知签名
-        verify_res = weChatPay().verify_notify_sign(request.headers, request.body)
+        verify_res = await wechat_client.run_sync(
+            lambda: weChatPay.instance().verify_notify_sign(
+                request.headers, request.body
+            ),
+            call="verify_notify_sign",
+        )
         if verify_res is None:
             raise Exception("支付通知签名验证失败")
 
@@ -184,13 +544,8 @@ async def pay_notify(request: Request):
         if trade_state != "SUCCESS":
             raise Exception(f"支付通知状态非正常 {str(resource)}")
 
-        # 更新订单为已支付
-        order = await Order.update_order_paid(out_trade_no, transaction_id)
-        if not order:
-            raise Exception(f"订单不存在 {out_trade_no}")
-
-        # 创建入闸机二维码
-        await EnterLog.get_enter_log_by_open_id(openid, order.id)
+        # 写入队列，重复通知直接应答
+        await app.ctx.pay_notify.enqueue(out_trade_no, transaction_id, openid)
 
         return response.json({"code": 200, "msg": "success"})
 
@@ -204,6 +559,37 @@ async def pay_notify(request: Request):
 """
 
 
+# 当前在场人数（总数、按场地、按进入闸机）
+@app.route("/occupancy")
+async def occupancy(request: Request):
+    return response.json(presence_tracker.occupancy())
+
+
+# 超过阈值秒数没有心跳的闸机
+@app.route("/offline_devices")
+async def offline_devices(request: Request):
+
+    try:
+        threshold = float(request.args.get("threshold", PRESENCE_CONFIG["stale_after"]))
+    except ValueError:
+        raise BadRequest("参数格式错误")
+
+    return response.json(
+        {
+            "threshold": threshold,
+            "devices": [
+                {
+                    "device_no": device_no,
+                    "last_seen": datetime.fromtimestamp(seen_at).isoformat(
+                        timespec="seconds"
+                    ),
+                }
+                for seen_at, device_no in presence_tracker.stale_devices(threshold)
+            ],
+        }
+    )
+
+
 # 闸机心跳
 @app.route("/getStatus")
 async def get_status(request: Request):
@@ -213,12 +599,22 @@ async def get_status(request: Request):
         Serial = request.args.get("Serial")
         if not key or not Serial:
             raise BadRequest("缺少参数: Key, Serial")
-
-        # 更新或创建设备并更新活跃状态
-        await Device.update_or_create_device(Serial)
+        presence_tracker.seen(Serial)
+
+        # 异常闸机频繁心跳时直接应答，不更新活跃时间
+        if not gate_throttle.allow_heartbeat(Serial):
+            metrics.inc("gate_shed_total", ("getStatus", "rate_limited"))
+        # 数据库繁忙时让出给扫码，只在内存中记录已知设备的心跳
+        elif gate_throttle.busy:
+            Device.record_known_heartbeat(Serial)
+            metrics.inc("gate_shed_total", ("getStatus", "overloaded"))
+        else:
+            # 更新或创建设备并更新活跃状态
+            async with gate_throttle.db_slot():
+                await Device.update_or_create_device(Serial)
 
     except Exception as e:
-        logger.info(f"闸机心跳,error: {e}")
+        heartbeat_logger.info("闸机心跳,error: {}", e)
 
     return response.json({"Key": key})
 
@@ -237,34 +633,68 @@ async def search_card_acs(request: Request):
         if int(type) != 9:
             raise BadRequest("类型必须为二维码")
 
-        # base64解码
-        Card = decodeBase64(Card).decode("utf-8")
-
-        # 更新或创建设备并更新活跃状态
-        await Device.update_or_create_device(Serial)
+        # base64解码并校验格式，格式错误不访问数据库
+        payload = parse_qr_payload(Card)
+        if payload is None:
+            raise AdmissionDenied(f"二维码 {Card} 格式错误", "qr_malformed")
 
-        # 维护进入记录
-        if Reader == 0:
-            await EnterLog.update_enter_log(Card, Serial)
-        # 维护退出记录
-        elif Reader == 1:
-            await EnterLog.update_leave_log(Card, Serial)
-        # 如果是其他类型，抛出错误
-        else:
+        if Reader not in (0, 1):
             raise BadRequest("Reader类型错误")
 
+        # 单台闸机请求过于频繁时拒绝，避免占用其他闸机的数据库额度
+        if not gate_throttle.allow_scan(Serial):
+            raise AdmissionDenied(f"闸机 {Serial} 请求过于频繁", "rate_limited")
+
+        async def admit():
+            # 先回放该二维码离线期间的进出事件，保证数据库状态与本地一致（其余日志由后台任务回放）
+            await app.ctx.offline_gate.replay_for(payload)
+
+            # 更新或创建设备并更新活跃状态
+            await Device.update_or_create_device(Serial)
+
+            # 维护进入记录
+            if Reader == 0:
+                await EnterLog.update_enter_log(payload, Serial)
+            # 维护退出记录
+            else:
+                await EnterLog.update_leave_log(payload, Serial)
+
+        # 排队等待数据库并发额度（不计入延迟预算），数据库超出预算或不可用时根据本地快照判断
+        mode = await app.ctx.offline_gate.decide(
+            admit,
+            payload,
+            Serial,
+            "enter" if Reader == 0 else "leave",
+            slot=gate_throttle.db_slot(),
+        )
+
         ActIndex = Reader
         AcsRes = "1"
         Time = "1"
+        metrics.inc(
+            "gate_admission_total",
+            (str(Reader), "allow", "ok" if mode == "online" else "offline"),
+        )
 
     except Exception as e:
-        logger.info(f"闸机请求,error: {e}")
+        scan_logger.info("闸机请求,error: {}", e)
         ActIndex = 0
         AcsRes = "0"
         Time = "0"
+        if isinstance(e, AdmissionDenied):
+            reason = e.reason
+        elif isinstance(e, BadRequest):
+            reason = "bad_request"
+        else:
+            reason = "error"
+        reader = request.args.get("Reader")
+        metrics.inc(
+            "gate_admission_total",
+            (reader if reader in ("0", "1") else "other", "deny", reason),
+        )
 
     return response.json({"ActIndex": ActIndex, "AcsRes": AcsRes, "Time": Time})
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=8000, debug=True)
+    app.run(**SERVER_CONFIG)
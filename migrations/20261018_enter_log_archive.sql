@@ -0,0 +1,22 @@
+-- 进入记录归档迁移
+-- 已离开超过保留期的进入记录由后台任务分批迁移到归档表，执行本脚本后设置 ARCHIVE_ENABLED=true 开启
+
+-- 1.离开时间索引（归档任务按离开时间分批扫描）
+ALTER TABLE enter_log
+    ADD INDEX idx_enter_log_leave_at (leave_at);
+
+-- 2.归档表，记录ID与原进入记录一致
+CREATE TABLE IF NOT EXISTS enter_log_archive (
+    id INT UNSIGNED NOT NULL PRIMARY KEY,
+    qrcode VARCHAR(255) NULL COMMENT '二维码',
+    enter_at DATETIME(0) NULL COMMENT '进入时间',
+    enter_device_no VARCHAR(255) NULL COMMENT '进入设备号',
+    leave_at DATETIME(0) NULL COMMENT '离开时间',
+    leave_device_no VARCHAR(255) NULL COMMENT '离开设备号',
+    created_at DATETIME(0) NULL,
+    updated_at DATETIME(0) NULL,
+    user_id INT NOT NULL COMMENT '用户ID',
+    order_id INT NOT NULL COMMENT '订单ID',
+    archived_at DATETIME(0) NULL COMMENT '归档时间',
+    KEY idx_enter_log_archive_user_id (user_id)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COMMENT='用户进入记录归档表';
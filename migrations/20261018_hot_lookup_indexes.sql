@@ -0,0 +1,26 @@
+-- 热点查询索引迁移
+-- 闸机扫码、心跳、支付回调、教练订单查询依赖以下索引，已部署的数据库执行本脚本补齐
+-- 执行前请先运行第1步检查重复数据，存在重复时唯一索引会创建失败
+
+-- 1.检查重复数据（结果均应为空）
+SELECT qrcode, COUNT(*) FROM enter_log WHERE qrcode IS NOT NULL GROUP BY qrcode HAVING COUNT(*) > 1;
+SELECT device_no, COUNT(*) FROM devices WHERE device_no IS NOT NULL GROUP BY device_no HAVING COUNT(*) > 1;
+SELECT order_no, COUNT(*) FROM orders GROUP BY order_no HAVING COUNT(*) > 1;
+
+-- 2.清理重复设备（保留最早创建的一条，设备记录可安全合并）
+DELETE d1 FROM devices d1
+JOIN devices d2 ON d1.device_no = d2.device_no AND d1.id > d2.id;
+
+-- 重复的订单号与二维码涉及支付与进出记录，需人工核对后处理，不在此自动删除
+
+-- 3.创建索引
+ALTER TABLE enter_log
+    ADD UNIQUE INDEX uid_enter_log_qrcode (qrcode),
+    ADD INDEX idx_enter_log_user_id_order_id_leave_at (user_id, order_id, leave_at);
+
+ALTER TABLE devices
+    ADD UNIQUE INDEX uid_devices_device_no (device_no);
+
+ALTER TABLE orders
+    ADD UNIQUE INDEX uid_orders_order_no (order_no),
+    ADD INDEX idx_orders_user_id_status_created_at (user_id, status, created_at);
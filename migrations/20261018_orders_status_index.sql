@@ -0,0 +1,5 @@
+-- 订单状态索引迁移
+-- 付款中订单对账任务按状态分页扫描订单
+
+ALTER TABLE orders
+    ADD INDEX idx_orders_status (status);
@@ -1,10 +1,67 @@
 from tortoise.models import Model
-from tortoise import fields
+from tortoise import fields, connections
+from tortoise.transactions import in_transaction
+from tortoise.exceptions import IntegrityError
 from tool import getNowTime
+import time
 import uuid
-from datetime import datetime
-import random
 from sanic.exceptions import BadRequest
+from service.admissionService import AdmissionDenied, AdmissionState, admission_index
+from service.heartbeatService import heartbeat_aggregator
+from service.presenceService import presence_tracker
+from service.eventService import event_bus
+from service.qrTokenService import QrTokenSigner
+from service.metricsService import metrics, timed
+from service.cacheService import SingleFlight, TTLCache
+from service.orderNoService import OrderNoGenerator
+from config import (
+    QR_TOKEN_CONFIG,
+    ORDER_NO_CONFIG,
+    USER_CACHE_CONFIG,
+    QRCODE_CACHE_CONFIG,
+    DB_READ_CONFIG,
+)
+
+# 二维码令牌签发与校验
+qr_token_signer = QrTokenSigner(**QR_TOKEN_CONFIG)
+
+# 订单号生成（进程内，无需查库）
+order_no_generator = OrderNoGenerator(**ORDER_NO_CONFIG)
+
+# 用户热点行缓存，键为 ("id", 用户ID) 或 ("openid", openid)
+user_cache = TTLCache(**USER_CACHE_CONFIG)
+
+# /qrcode 响应短期缓存与并发请求合并，键为 (用户ID, 订单ID)
+qrcode_cache = TTLCache(**QRCODE_CACHE_CONFIG)
+qrcode_flight = SingleFlight()
+
+
+def _invalidate_on_event(user_id, event):
+    """其他worker的进出闸、支付事件：清除本worker对应的 /qrcode 缓存"""
+    if "order_id" in event:
+        qrcode_cache.pop((str(user_id), str(event["order_id"])))
+
+
+# 缓存中有未过期的响应时保持同步其他worker的事件
+event_bus.listen(_invalidate_on_event, qrcode_cache.alive)
+
+# 近期有写入的用户，副本同步前这些用户的读取走主库
+recent_writers = TTLCache(
+    maxsize=DB_READ_CONFIG["maxsize"], ttl=DB_READ_CONFIG["sticky_seconds"]
+)
+
+
+def mark_user_write(user_id):
+    """记录用户刚写入过数据"""
+    if DB_READ_CONFIG["enabled"]:
+        recent_writers.set(str(user_id), True)
+
+
+def read_db(user_id):
+    """纯读查询使用的连接，未配置副本或该用户刚写入过时返回None（使用主库）"""
+    if not DB_READ_CONFIG["enabled"] or recent_writers.get(str(user_id)):
+        return None
+    return connections.get("read")
 
 
 # 自定义MyDatetimeField，用于MySQL中设置DATETIME(0)
@@ -29,8 +86,33 @@ class User(Model):
         table_description = "用户表"
 
     @classmethod
+    async def get_cached_user(cls, id=None, openid=None):
+        """按ID或openid获取用户，优先读取进程内缓存
+
+        缓存的实例在请求间共享，只可读取；其他worker更新的昵称等信息最多延迟一个TTL
+        """
+        key = ("id", str(id)) if id is not None else ("openid", openid)
+        user = user_cache.get(key)
+        if user is not None:
+            metrics.inc("cache_requests_total", ("user", "hit"))
+            return user
+
+        metrics.inc("cache_requests_total", ("user", "miss"))
+        user = await cls.get_or_none(**{key[0]: key[1]})
+        if user is not None:
+            cls._cache_user(user)
+        return user
+
+    @staticmethod
+    def _cache_user(user):
+        user_cache.set(("id", str(user.id)), user)
+        if user.openid:
+            user_cache.set(("openid", user.openid), user)
+
+    @classmethod
+    @timed("db_call_duration_seconds")
     async def get_or_create_user(cls, openid, nickname=None, avatar=None, phone=None):
-        # 检查用户是否存在
+        # 检查用户是否存在（需要写入，不读缓存）
         user = await cls.get_or_none(openid=openid)
         current_time = getNowTime()
 
@@ -62,17 +144,22 @@ class User(Model):
                 update_fields.append("updated_at")
                 await user.save(update_fields=update_fields)
 
+        # 用最新数据替换缓存
+        cls._cache_user(user)
+        mark_user_write(user.id)
         return user
 
 
 class EnterLog(Model):
     id = fields.IntField(pk=True, unsigned=True, auto_increment=True)
-    qrcode = fields.CharField(max_length=255, null=True, description="二维码")
+    qrcode = fields.CharField(
+        max_length=255, null=True, unique=True, description="二维码"
+    )
     enter_at = MyDatetimeField(null=True, description="进入时间")
     enter_device_no = fields.CharField(
         max_length=255, null=True, description="进入设备号"
     )
-    leave_at = MyDatetimeField(null=True, description="离开时间")
+    leave_at = MyDatetimeField(null=True, index=True, description="离开时间")
     leave_device_no = fields.CharField(
         max_length=255, null=True, description="离开设备号"
     )
@@ -84,9 +171,11 @@ class EnterLog(Model):
     class Meta:
         table = "enter_log"
         table_description = "用户进入记录表"
+        indexes = (("user_id", "order_id", "leave_at"),)
 
     @classmethod
-    async def create_enter_log(cls, user_id, order_id):
+    @timed("db_call_duration_seconds")
+    async def create_enter_log(cls, user_id, order_id, using_db=None):
         """创建用户进入记录"""
 
         current_time = getNowTime()
@@ -97,77 +186,416 @@ class EnterLog(Model):
             qrcode=str(uuid.uuid4()),
             created_at=current_time,
             updated_at=current_time,
+            using_db=using_db,
         )
+        # 同步到准入索引
+        admission_index.put(AdmissionState.from_row(enter_log))
+        cls.invalidate_qrcode_cache(user_id, order_id)
+        mark_user_write(user_id)
         return enter_log
 
     @classmethod
+    async def create_visitor_enter_log(cls, user_id):
+        """创建游客进入记录，并发创建时保留ID最小的一条，删除自己创建的重复记录"""
+        enter_log = await cls.create_enter_log(user_id, 0)
+        first = (
+            await cls.filter(user_id=user_id, order_id=0, leave_at=None)
+            .order_by("id")
+            .first()
+        )
+        if first is None or first.id == enter_log.id:
+            return enter_log
+
+        await cls.filter(id=enter_log.id).delete()
+        admission_index.remove(enter_log.qrcode)
+        return first
+
+    @staticmethod
+    def publish_state_event(state, type, at):
+        """推送进出事件给该用户的WebSocket连接"""
+        event_bus.publish(
+            state.user_id,
+            {"type": type, "order_id": state.order_id, "at": str(at)},
+        )
+
+    @staticmethod
+    def invalidate_qrcode_cache(user_id, order_id):
+        """进出状态变化后清除本worker的 /qrcode 响应缓存（其他worker通过用户事件清除）"""
+        qrcode_cache.pop((str(user_id), str(order_id)))
+
+    @classmethod
+    async def get_open_admission_states(cls):
+        """读取所有未离开记录的准入状态"""
+        rows = await cls.filter(leave_at=None).values(
+            "id",
+            "qrcode",
+            "user_id",
+            "order_id",
+            "enter_at",
+            "enter_device_no",
+            "leave_at",
+            "leave_device_no",
+        )
+        return [AdmissionState.from_row(row) for row in rows]
+
+    @classmethod
+    async def warm_admission_index(cls):
+        """启动时从未离开的记录预热准入索引"""
+        admission_index.load(await cls.get_open_admission_states())
+        return len(admission_index)
+
+    @classmethod
+    @timed("db_call_duration_seconds")
+    async def get_admission_state(cls, payload):
+        """优先从准入索引获取状态，未命中时回源数据库（如其他进程创建的记录）
+
+        payload 为解析后的二维码内容；签名令牌先在CPU中校验，伪造或过期直接拒绝，有效令牌按主键查找
+        """
+        qrcode = payload.value
+        if payload.is_token and qr_token_signer.can_verify:
+            token = qr_token_signer.verify(qrcode)
+            state = admission_index.get_by_id(token.enter_log_id)
+            if state is None:
+                state = await cls.refresh_admission_state(token.enter_log_id)
+            if state is None or (state.user_id, state.order_id) != (
+                token.user_id,
+                token.order_id,
+            ):
+                return None
+            return state
+
+        state = admission_index.get(qrcode)
+        if state is None:
+            enter_log = await cls.get_or_none(qrcode=qrcode)
+            if enter_log is None:
+                return None
+            state = AdmissionState.from_row(enter_log)
+            admission_index.put(state)
+        return state
+
+    @classmethod
+    async def refresh_admission_state(cls, enter_log_id):
+        """按主键读取最新状态并刷新准入索引"""
+        enter_log = await cls.get_or_none(id=enter_log_id)
+        if enter_log is None:
+            state = admission_index.get_by_id(enter_log_id)
+            if state is not None:
+                admission_index.remove(state.qrcode)
+            return None
+        state = AdmissionState.from_row(enter_log)
+        admission_index.put(state)
+        return state
+
+    def get_display_qrcode(self):
+        """二维码展示内容，开启签名令牌时返回令牌，否则返回原始qrcode"""
+        if qr_token_signer.enabled:
+            return qr_token_signer.sign(self.id, self.user_id, self.order_id)
+        return self.qrcode
+
+    @classmethod
+    @timed("db_call_duration_seconds")
     async def get_enter_log_by_user_id(cls, user_id, order_id):
         """获取用户信息"""
-        user = await User.get_or_none(id=user_id)
+        user = await User.get_cached_user(id=user_id)
         if not user:
             raise BadRequest("未找到用户")
 
-        enter_log = await cls.get_or_none(
-            user_id=user.id, order_id=order_id, leave_at=None
+        # 兼容历史重复记录，取ID最小的一条；优先读副本，副本未同步时回主库确认
+        query = cls.filter(user_id=user.id, order_id=order_id, leave_at=None).order_by(
+            "id"
         )
+        db = read_db(user.id)
+        enter_log = await query.using_db(db).first()
+        if enter_log is None and db is not None:
+            enter_log = await query.first()
 
         # 游客没有订单直接创建，教练的已经生成，不会走到这一步
         if enter_log is None and int(order_id) == 0:
-            enter_log = await cls.create_enter_log(user.id, order_id)
+            enter_log = await cls.create_visitor_enter_log(user.id)
 
         return enter_log
 
     @classmethod
+    async def get_qrcode_payload(cls, user_id, order_id):
+        """/qrcode 响应内容，短期缓存，同一用户的并发轮询只查询一次"""
+        key = (str(user_id), str(order_id))
+        payload = qrcode_cache.get(key)
+        if payload is not None:
+            metrics.inc("cache_requests_total", ("qrcode", "hit"))
+            return payload
+
+        metrics.inc("cache_requests_total", ("qrcode", "miss"))
+
+        async def load():
+            read_at = time.time()
+            enter_log = await cls.get_enter_log_by_user_id(user_id, order_id)
+            if enter_log is None:
+                raise BadRequest("未找到入闸二维码")
+            payload = {
+                "qrcode": enter_log.get_display_qrcode(),
+                "enter_at": (
+                    enter_log.enter_at.isoformat() if enter_log.enter_at else None
+                ),
+                "leave_at": (
+                    enter_log.leave_at.isoformat() if enter_log.leave_at else None
+                ),
+                "created_at": (
+                    enter_log.created_at.isoformat() if enter_log.created_at else None
+                ),
+            }
+            qrcode_cache.set(key, payload)
+            # 同步查询开始后其他worker写入的事件，其中的状态变化会清除这次缓存
+            event_bus.ensure_running(since=read_at)
+            return payload
+
+        return await qrcode_flight.do(key, load)
+
+    @classmethod
+    @timed("db_call_duration_seconds")
     async def get_enter_log_by_open_id(cls, open_id, order_id):
         """获取用户信息"""
-        user = await User.get_or_none(openid=open_id)
+        user = await User.get_cached_user(openid=open_id)
         if not user:
             raise BadRequest("未找到用户")
 
-        return await cls.create_enter_log(user.id, order_id)
+        # 重复处理同一订单时复用已创建的记录（兼容历史重复记录，取ID最小的一条）
+        query = cls.filter(user_id=user.id, order_id=order_id).order_by("id")
+        enter_log = await query.first()
+        if enter_log:
+            return enter_log
+
+        # 通知租约过期被其他worker重新领取时可能并发处理同一订单，锁定订单行后再确认
+        async with in_transaction() as conn:
+            await Order.filter(id=order_id).select_for_update().using_db(conn).first()
+            enter_log = await query.using_db(conn).first()
+            if enter_log:
+                return enter_log
+            return await cls.create_enter_log(user.id, order_id, using_db=conn)
+
+    @staticmethod
+    def _check_enter(state, qrcode):
+        if not state:
+            raise AdmissionDenied(f"未找到 {qrcode} 的授权记录", "not_found")
+        if state.entered:
+            raise AdmissionDenied(
+                f"此二维码 {qrcode} 记录判断此前已进入", "already_entered"
+            )
+        if state.left:
+            raise AdmissionDenied(
+                f"此二维码 {qrcode} 记录判断此前已离开", "already_left"
+            )
+
+    @staticmethod
+    def _check_leave(state, qrcode):
+        if not state:
+            raise AdmissionDenied(f"未找到 {qrcode} 的授权记录", "not_found")
+        if not state.entered:
+            raise AdmissionDenied(
+                f"此二维码 {qrcode} 记录判断此前还未进入", "not_entered"
+            )
+        if state.left:
+            raise AdmissionDenied(
+                f"此二维码 {qrcode} 记录判断此前已离开", "already_left"
+            )
 
     @classmethod
-    async def update_enter_log(cls, qrcode, device_no):
-
-        # 维护进入
-        enter_log = await cls.get_or_none(qrcode=qrcode)
-        if not enter_log:
-            raise BadRequest(f"未找到 {qrcode} 的授权记录")
-        if enter_log.enter_at or enter_log.enter_device_no:
-            raise BadRequest(f"此二维码 {qrcode} 记录判断此前已进入")
-        if enter_log.leave_at or enter_log.leave_device_no:
-            raise BadRequest(f"此二维码 {qrcode} 记录判断此前已离开")
-
-        # 更新进入时间和设备号
+    @timed("db_call_duration_seconds")
+    async def update_enter_log(cls, payload, device_no):
+
+        # 维护进入，先在内存中判断
+        qrcode = payload.value
+        state = await cls.get_admission_state(payload)
+        try:
+            cls._check_enter(state, qrcode)
+        except AdmissionDenied:
+            # 索引中的状态可能已被其他worker更新，拒绝前按主键确认最新状态
+            if state is None:
+                raise
+            state = await cls.refresh_admission_state(state.id)
+            cls._check_enter(state, qrcode)
+
+        # 条件UPDATE保证同一二维码只能进入一次，写库成功后再更新内存状态
+        # （超出延迟预算时离线判断与本次写库并行，不能提前看到未提交的状态）
         current_time = getNowTime()
-        enter_log.enter_at = current_time
-        enter_log.enter_device_no = device_no
-        enter_log.updated_at = current_time
-        await enter_log.save()
+        updated = await cls.filter(id=state.id, enter_at=None, leave_at=None).update(
+            enter_at=current_time,
+            enter_device_no=device_no,
+            updated_at=current_time,
+        )
+
+        # 未更新到记录说明已被其他闸机处理，读取最新状态给出具体原因
+        if not updated:
+            state = await cls.refresh_admission_state(state.id)
+            cls._check_enter(state, qrcode)
+            raise AdmissionDenied(f"此二维码 {qrcode} 记录状态已变化", "state_changed")
+
+        state.entered = True
+        state.gate = device_no
+        state.touch()
+        admission_index.put(state)
+        cls.invalidate_qrcode_cache(state.user_id, state.order_id)
+        presence_tracker.entered(device_no)
+        mark_user_write(state.user_id)
+        cls.publish_state_event(state, "enter", current_time)
 
     @classmethod
-    async def update_leave_log(cls, qrcode, device_no):
-
-        # 维护离开
-        enter_log = await cls.get_or_none(qrcode=qrcode)
-        if not enter_log:
-            raise BadRequest(f"未找到 {qrcode} 的授权记录")
-        if not enter_log.enter_at or not enter_log.enter_device_no:
-            raise BadRequest(f"此二维码 {qrcode} 记录判断此前还未进入")
-        if enter_log.leave_at or enter_log.leave_device_no:
-            raise BadRequest(f"此二维码 {qrcode} 记录判断此前已离开")
-
-        # 更新离开时间和设备号
+    @timed("db_call_duration_seconds")
+    async def update_leave_log(cls, payload, device_no):
+
+        # 维护离开，先在内存中判断
+        qrcode = payload.value
+        state = await cls.get_admission_state(payload)
+        try:
+            cls._check_leave(state, qrcode)
+        except AdmissionDenied:
+            # 索引中的状态可能已被其他worker更新，拒绝前按主键确认最新状态
+            if state is None:
+                raise
+            state = await cls.refresh_admission_state(state.id)
+            cls._check_leave(state, qrcode)
+
+        # 条件UPDATE保证同一二维码只能离开一次，写库成功后再更新内存状态
         current_time = getNowTime()
-        enter_log.leave_at = current_time
-        enter_log.leave_device_no = device_no
-        enter_log.updated_at = current_time
-        await enter_log.save()
+        updated = await cls.filter(
+            id=state.id, enter_at__isnull=False, leave_at=None
+        ).update(
+            leave_at=current_time,
+            leave_device_no=device_no,
+            updated_at=current_time,
+        )
+
+        # 未更新到记录说明已被其他闸机处理，读取最新状态给出具体原因
+        if not updated:
+            state = await cls.refresh_admission_state(state.id)
+            cls._check_leave(state, qrcode)
+            raise AdmissionDenied(f"此二维码 {qrcode} 记录状态已变化", "state_changed")
+
+        state.left = True
+        cls.invalidate_qrcode_cache(state.user_id, state.order_id)
+        presence_tracker.left(state.gate)
+        admission_index.remove(state.qrcode)
+        mark_user_write(state.user_id)
+        cls.publish_state_event(state, "leave", current_time)
+
+    @classmethod
+    @timed("db_call_duration_seconds")
+    async def apply_offline_event(cls, enter_log_id, action, device_no, at):
+        """回放离线期间的进出事件，返回更新的记录数，0表示已被处理
+
+        离线放行时已校验过进出顺序，不同worker的日志回放顺序不定，进入与离开各自只写一次
+        """
+        if action == "enter":
+            return await cls.filter(id=enter_log_id, enter_at=None).update(
+                enter_at=at, enter_device_no=device_no, updated_at=at
+            )
+        return await cls.filter(id=enter_log_id, leave_at=None).update(
+            leave_at=at, leave_device_no=device_no, updated_at=at
+        )
+
+    @classmethod
+    @timed("db_call_duration_seconds")
+    async def archive_closed(cls, before, batch_size=500):
+        """将离开时间早于before的一批记录迁移到归档表，返回迁移条数
+
+        每批在独立的短事务中完成，多个worker同时执行时跳过已被锁定的行
+        """
+        async with in_transaction() as conn:
+            enter_logs = (
+                await cls.filter(leave_at__lt=before)
+                .order_by("id")
+                .limit(batch_size)
+                .select_for_update(skip_locked=True)
+                .using_db(conn)
+            )
+            if not enter_logs:
+                return 0
+
+            archived_at = getNowTime()
+            await EnterLogArchive.bulk_create(
+                [
+                    EnterLogArchive(
+                        id=enter_log.id,
+                        qrcode=enter_log.qrcode,
+                        enter_at=enter_log.enter_at,
+                        enter_device_no=enter_log.enter_device_no,
+                        leave_at=enter_log.leave_at,
+                        leave_device_no=enter_log.leave_device_no,
+                        created_at=enter_log.created_at,
+                        updated_at=enter_log.updated_at,
+                        user_id=enter_log.user_id,
+                        order_id=enter_log.order_id,
+                        archived_at=archived_at,
+                    )
+                    for enter_log in enter_logs
+                ],
+                ignore_conflicts=True,
+                using_db=conn,
+            )
+            await (
+                cls.filter(id__in=[enter_log.id for enter_log in enter_logs])
+                .using_db(conn)
+                .delete()
+            )
+        return len(enter_logs)
+
+    @classmethod
+    @timed("db_call_duration_seconds")
+    async def get_history(cls, user_id, limit=20, before_id=None):
+        """按ID倒序查询用户的进出记录，包括已归档的记录"""
+        filters = {"user_id": user_id}
+        if before_id is not None:
+            filters["id__lt"] = before_id
+        columns = ("id", "order_id", "enter_at", "leave_at", "created_at")
+
+        # 记录ID在归档后保持不变，两张表各取limit条后合并
+        db = read_db(user_id)
+        recent = (
+            await cls.filter(**filters)
+            .using_db(db)
+            .order_by("-id")
+            .limit(limit)
+            .values(*columns)
+        )
+        archived = (
+            await EnterLogArchive.filter(**filters)
+            .using_db(db)
+            .order_by("-id")
+            .limit(limit)
+            .values(*columns)
+        )
+        rows = sorted(recent + archived, key=lambda row: row["id"], reverse=True)
+        return rows[:limit]
+
+
+class EnterLogArchive(Model):
+    """已离开且超过保留期的进入记录，由 EnterLog.archive_closed 迁移，ID与原记录一致"""
+
+    id = fields.IntField(pk=True, unsigned=True, generated=False)
+    qrcode = fields.CharField(max_length=255, null=True, description="二维码")
+    enter_at = MyDatetimeField(null=True, description="进入时间")
+    enter_device_no = fields.CharField(
+        max_length=255, null=True, description="进入设备号"
+    )
+    leave_at = MyDatetimeField(null=True, description="离开时间")
+    leave_device_no = fields.CharField(
+        max_length=255, null=True, description="离开设备号"
+    )
+    created_at = MyDatetimeField(null=True)
+    updated_at = MyDatetimeField(null=True)
+    user_id = fields.IntField(index=True, description="用户ID")
+    order_id = fields.IntField(description="订单ID")
+    archived_at = MyDatetimeField(null=True, description="归档时间")
+
+    class Meta:
+        table = "enter_log_archive"
+        table_description = "用户进入记录归档表"
 
 
 class Device(Model):
     id = fields.IntField(pk=True, unsigned=True, auto_increment=True)
-    device_no = fields.CharField(max_length=255, null=True, description="设备号")
+    device_no = fields.CharField(
+        max_length=255, null=True, unique=True, description="设备号"
+    )
     first_active_at = MyDatetimeField(null=True, description="激活时间")
     active_at = MyDatetimeField(null=True, description="活跃时间")
     created_at = MyDatetimeField(null=True)
@@ -177,38 +605,87 @@ class Device(Model):
         table = "devices"
         table_description = "设备表"
 
+    @staticmethod
+    def record_known_heartbeat(device_no):
+        """已知设备只在内存中记录心跳，未知设备返回False"""
+        if not heartbeat_aggregator.is_known(device_no):
+            return False
+        heartbeat_aggregator.record(device_no, getNowTime())
+        return True
+
     @classmethod
+    @timed("db_call_duration_seconds")
     async def update_or_create_device(cls, device_no):
-        """更新或创建设备记录，并更新活跃状态"""
+        """更新或创建设备记录，并更新活跃状态
+
+        已知设备只在内存中记录心跳，由 flush_heartbeats 定时批量落库
+        """
+        if cls.record_known_heartbeat(device_no):
+            return
+
         # 检查设备是否存在
-        device = await cls.get_or_none(device_no=device_no)
         current_time = getNowTime()
-
+        device = await cls.get_or_none(device_no=device_no)
         if not device:
-            # 创建新设备记录
-            device = await cls.create(
-                device_no=device_no,
-                first_active_at=current_time,
-                active_at=current_time,
-                created_at=current_time,
-                updated_at=current_time,
-            )
+            # 创建新设备记录，并发创建时由唯一索引兜底
+            try:
+                await cls.create(
+                    device_no=device_no,
+                    first_active_at=current_time,
+                    active_at=current_time,
+                    created_at=current_time,
+                    updated_at=current_time,
+                )
+            except IntegrityError:
+                heartbeat_aggregator.record(device_no, current_time)
         else:
-            # 更新设备活跃状态
-            update_fields = []
-            # 如果是首次激活，更新first_active_at
-            if not device.first_active_at:
-                device.first_active_at = current_time
-                update_fields.append("first_active_at")
-
-            # 始终更新active_at和updated_at
-            device.active_at = current_time
-            device.updated_at = current_time
-            update_fields.extend(["active_at", "updated_at"])
+            heartbeat_aggregator.record(device_no, current_time)
+        heartbeat_aggregator.mark_known(device_no)
 
-            await device.save(update_fields=update_fields)
+    @classmethod
+    async def warm_heartbeat_devices(cls):
+        """启动时加载已存在的设备号"""
+        device_nos = await cls.all().values_list("device_no", flat=True)
+        heartbeat_aggregator.load_known(device_nos)
+        return len(device_nos)
 
-        return device
+    @classmethod
+    @timed("db_call_duration_seconds")
+    async def flush_heartbeats(cls, batch_size=500):
+        """将内存中的心跳合并为批量UPDATE写入数据库"""
+        pending = heartbeat_aggregator.drain()
+        if not pending:
+            return 0
+
+        db = cls._meta.db
+        mark = "%s" if db.capabilities.dialect == "mysql" else "?"
+        items = list(pending.items())
+        try:
+            for start in range(0, len(items), batch_size):
+                batch = items[start : start + batch_size]
+                case_sql = (
+                    "CASE device_no "
+                    + " ".join([f"WHEN {mark} THEN {mark}"] * len(batch))
+                    + " END"
+                )
+                case_values = [value for item in batch for value in item]
+                device_nos = [device_no for device_no, _ in batch]
+                sql = (
+                    f"UPDATE {cls._meta.db_table} SET "
+                    f"active_at = {case_sql}, "
+                    f"updated_at = {case_sql}, "
+                    f"first_active_at = COALESCE(first_active_at, {case_sql}) "
+                    f"WHERE device_no IN ({', '.join([mark] * len(batch))})"
+                )
+                await db.execute_query(sql, case_values * 3 + device_nos)
+                # 已写入的批次不再重试
+                for device_no in device_nos:
+                    pending.pop(device_no)
+        except BaseException:
+            heartbeat_aggregator.restore(pending)
+            raise
+
+        return len(items)
 
 
 class Order(Model):
@@ -220,7 +697,9 @@ class Order(Model):
     STATUS_CANCELLED = 50  # 已取消
 
     id = fields.IntField(pk=True, unsigned=True, auto_increment=True)
-    order_no = fields.CharField(max_length=255, default="", description="订单号")
+    order_no = fields.CharField(
+        max_length=255, default="", unique=True, description="订单号"
+    )
     out_order_no = fields.CharField(
         max_length=255, default="", description="外部订单号"
     )
@@ -229,6 +708,7 @@ class Order(Model):
     )
     status = fields.IntField(
         default=STATUS_CREATED,
+        index=True,
         description="状态 10已创建 20付款中 30已完成 40已失败 50已取消",
     )
     note = fields.TextField(description="备注")
@@ -240,20 +720,18 @@ class Order(Model):
     class Meta:
         table = "orders"
         table_description = "订单表"
+        indexes = (("user_id", "status", "created_at"),)
 
     @classmethod
     def generate_order_no(cls):
-        # 获取当前时间
-        now = datetime.now().strftime("%Y%m%d%H%M%S")
-        # 生成5位随机数
-        random_part = str(random.randint(10000, 99999))
-        # 组合订单号
-        return now + random_part
+        # 时间 + 节点号 + worker序号 + 序列号，多进程间不重复
+        return order_no_generator.generate()
 
     @classmethod
+    @timed("db_call_duration_seconds")
     async def create_order(cls, user_id, money):
         """获取用户信息"""
-        user = await User.get_or_none(id=user_id)
+        user = await User.get_cached_user(id=user_id)
         if not user:
             raise BadRequest("未找到用户")
 
@@ -271,22 +749,33 @@ class Order(Model):
             created_at=current_time,
             updated_at=current_time,
         )
+        mark_user_write(user.id)
 
         return order, user
 
     @classmethod
+    @timed("db_call_duration_seconds")
     async def update_order_paid(cls, order_no, transaction_id):
-        """根据订单号更新订单为已支付"""
-        order = await cls.get_or_none(order_no=order_no, status=cls.STATUS_PAYING)
+        """根据订单号更新订单为已支付，重复通知时返回已支付的订单（幂等）"""
+        current_time = getNowTime()
+        # 预支付超时被标记为失败、但用户实际已支付的订单，以支付结果为准
+        await cls.filter(
+            order_no=order_no, status__in=[cls.STATUS_PAYING, cls.STATUS_FAILED]
+        ).update(
+            status=cls.STATUS_COMPLETED,
+            out_order_no=transaction_id,
+            paid_at=current_time,
+            updated_at=current_time,
+        )
+        order = await cls.get_or_none(order_no=order_no, status=cls.STATUS_COMPLETED)
+        if order and order.out_order_no != transaction_id:
+            return None
         if order:
-            order.status = cls.STATUS_COMPLETED
-            order.out_order_no = transaction_id
-            order.paid_at = getNowTime()
-            order.updated_at = getNowTime()
-            await order.save()
+            mark_user_write(order.user_id)
         return order
 
     @classmethod
+    @timed("db_call_duration_seconds")
     async def update_order_pay_fail(cls, order_no, note):
         """根据订单号更新订单为失败"""
         order = await cls.get_or_none(order_no=order_no)
@@ -295,13 +784,40 @@ class Order(Model):
             order.note = note
             order.updated_at = getNowTime()
             await order.save()
+            mark_user_write(order.user_id)
         return order
 
     @classmethod
-    async def get_user_last_order(cls, user_id):
-        """根据用户ID获取用户最新订单"""
+    @timed("db_call_duration_seconds")
+    async def get_stale_paying_orders(cls, before, after_id=0, limit=100):
+        """按ID分页获取创建时间早于before仍在付款中的订单"""
         return (
-            await cls.get_or_none(user_id=user_id, status=cls.STATUS_COMPLETED)
-            .order_by("-created_at")
-            .first()
+            await cls.filter(
+                status=cls.STATUS_PAYING, created_at__lt=before, id__gt=after_id
+            )
+            .order_by("id")
+            .limit(limit)
         )
+
+    @classmethod
+    @timed("db_call_duration_seconds")
+    async def update_paying_orders(cls, order_nos, status, note):
+        """批量更新仍在付款中的订单状态，返回更新条数"""
+        if not order_nos:
+            return 0
+        return await cls.filter(
+            order_no__in=order_nos, status=cls.STATUS_PAYING
+        ).update(status=status, note=note, updated_at=getNowTime())
+
+    @classmethod
+    @timed("db_call_duration_seconds")
+    async def get_user_last_order(cls, user_id):
+        """根据用户ID获取用户最新订单，优先读副本，副本未同步时回主库确认"""
+        query = cls.filter(user_id=user_id, status=cls.STATUS_COMPLETED).order_by(
+            "-created_at"
+        )
+        db = read_db(user_id)
+        order = await query.using_db(db).first()
+        if order is None and db is not None:
+            order = await query.first()
+        return order
@@ -0,0 +1,131 @@
+"""
+闸机准入索引
+进程内缓存所有未离开的进入记录的进出状态，闸机扫码时直接在内存中判断是否放行，
+放行后再写库（write-through），未命中时由调用方回源数据库并补充索引；
+其他worker处理的离开不会同步到本worker，条目超过ttl秒视为未命中重新回源，总数超过maxsize时淘汰最早的条目
+"""
+
+import time
+from collections import OrderedDict
+from sanic.exceptions import BadRequest
+from config import ADMISSION_INDEX_CONFIG
+
+
+class AdmissionDenied(BadRequest):
+    """闸机拒绝放行，reason用于按原因统计"""
+
+    def __init__(self, message, reason):
+        super().__init__(message)
+        self.reason = reason
+
+
+class AdmissionState:
+    """单条进入记录的准入状态"""
+
+    __slots__ = (
+        "id",
+        "qrcode",
+        "user_id",
+        "order_id",
+        "entered",
+        "left",
+        "gate",
+        "synced_at",
+    )
+
+    def __init__(
+        self,
+        id,
+        qrcode,
+        user_id,
+        order_id,
+        entered=False,
+        left=False,
+        gate=None,
+        synced_at=None,
+    ):
+        self.id = id
+        self.qrcode = qrcode
+        self.user_id = user_id
+        self.order_id = order_id
+        self.entered = entered
+        self.left = left
+        # 进入时的闸机设备号
+        self.gate = gate
+        # 最后一次从数据库读取或本地更新的时间戳，用于判断哪份状态较新
+        self.synced_at = time.time() if synced_at is None else synced_at
+
+    def touch(self):
+        self.synced_at = time.time()
+
+    @classmethod
+    def from_row(cls, row):
+        """根据EnterLog实例或values()字典构造状态"""
+        if isinstance(row, dict):
+            get = row.get
+        else:
+            get = lambda name: getattr(row, name)  # noqa: E731
+        return cls(
+            id=get("id"),
+            qrcode=get("qrcode"),
+            user_id=get("user_id"),
+            order_id=get("order_id"),
+            entered=bool(get("enter_at") or get("enter_device_no")),
+            left=bool(get("leave_at") or get("leave_device_no")),
+            gate=get("enter_device_no"),
+        )
+
+
+class AdmissionIndex:
+    """以qrcode为键的准入索引，只保存尚未离开的记录"""
+
+    def __init__(self, ttl=300, maxsize=100000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        # 按写入顺序排列，淘汰时从最早的开始
+        self._states = OrderedDict()
+        # 进入记录ID -> 状态，供签名令牌按主键查找
+        self._states_by_id = {}
+
+    def __len__(self):
+        return len(self._states)
+
+    def _fresh(self, state):
+        if state is None or time.time() - state.synced_at <= self.ttl:
+            return state
+        self.remove(state.qrcode)
+        return None
+
+    def get(self, qrcode):
+        return self._fresh(self._states.get(qrcode))
+
+    def get_by_id(self, enter_log_id):
+        return self._fresh(self._states_by_id.get(enter_log_id))
+
+    def put(self, state):
+        if state.left:
+            self.remove(state.qrcode)
+            return
+        self.remove(state.qrcode)
+        self._states[state.qrcode] = state
+        self._states_by_id[state.id] = state
+        while len(self._states) > self.maxsize:
+            _, evicted = self._states.popitem(last=False)
+            self._states_by_id.pop(evicted.id, None)
+
+    def remove(self, qrcode):
+        state = self._states.pop(qrcode, None)
+        if state is not None:
+            self._states_by_id.pop(state.id, None)
+
+    def load(self, states):
+        """用数据库中的未离开记录整体替换索引"""
+        self._states = OrderedDict()
+        self._states_by_id = {}
+        for state in states:
+            if state.qrcode:
+                self.put(state)
+
+
+# 进程内单例
+admission_index = AdmissionIndex(**ADMISSION_INDEX_CONFIG)
@@ -0,0 +1,76 @@
+"""
+进程内缓存工具
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """带过期时间与容量上限的LRU缓存，记录命中/未命中次数"""
+
+    def __init__(self, maxsize=10000, ttl=300):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        # key -> (过期时间, 值)
+        self._data = OrderedDict()
+        # 最晚写入的缓存的过期时间
+        self._expire_at = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        item = self._data.get(key)
+        if item is None:
+            self.misses += 1
+            return default
+        if item[0] <= time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return item[1]
+
+    def set(self, key, value, ttl=None):
+        expire_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        self._expire_at = max(self._expire_at, expire_at)
+        self._data[key] = (expire_at, value)
+        self._data.move_to_end(key)
+        # 超出容量时淘汰最久未使用的
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def alive(self):
+        """是否可能还有未过期的缓存"""
+        return bool(self._data) and time.monotonic() < self._expire_at
+
+    def pop(self, key, default=None):
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        self._data.clear()
+
+
+class SingleFlight:
+    """相同key的并发调用合并为一次执行，所有调用方共享结果或异常"""
+
+    def __init__(self):
+        self._tasks = {}
+
+    def __len__(self):
+        return len(self._tasks)
+
+    async def do(self, key, func):
+        task = self._tasks.get(key)
+        if task is None:
+            task = asyncio.ensure_future(func())
+            self._tasks[key] = task
+            task.add_done_callback(lambda _: self._tasks.pop(key, None))
+        # 单个调用方被取消（如客户端断开）不影响其他等待者
+        return await asyncio.shield(task)
@@ -0,0 +1,174 @@
+"""
+用户事件推送
+进出闸、支付成功等状态变化按用户推送给 WebSocket 连接，代替小程序轮询 /qrcode：
+本worker的连接直接分发；同时批量写入共享的SQLite事件表，各worker轮询后分发给自己的连接；
+后台同步任务只在本worker有连接、有待写入事件或有监听方（如 /qrcode 缓存）需要时运行，否则不轮询事件表
+"""
+
+import asyncio
+import json
+import time
+from loguru import logger
+from tool import connectSqlite
+from config import EVENT_CONFIG
+from service.workerService import get_worker_id
+
+
+class EventBus:
+    """按用户ID的事件订阅与跨worker分发"""
+
+    def __init__(
+        self, path="data/events.db", poll_interval=0.2, retention=60, queue_size=100
+    ):
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self.queue_size = queue_size
+        self.worker = get_worker_id()
+        # 用户ID -> 该用户在本worker的连接队列
+        self._subscribers = {}
+        # (回调, 是否需要事件) 列表，接收其他worker的所有事件
+        self._listeners = []
+        # 待写入事件表的 (用户ID, 事件JSON)
+        self._pending = []
+        self._conn = None
+        # 已分发到的事件表序号，同步任务停止后重置
+        self._last_seq = None
+        self._task = None
+        self._started_at = 0
+        self._last_prune = time.monotonic()
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = connectSqlite(self.path)
+            self._conn.executescript(
+                "CREATE TABLE IF NOT EXISTS events ("
+                "seq INTEGER PRIMARY KEY AUTOINCREMENT, worker TEXT NOT NULL, "
+                "user_id TEXT NOT NULL, payload TEXT NOT NULL, created_at REAL NOT NULL);"
+                "CREATE INDEX IF NOT EXISTS idx_events_created_at ON events (created_at);"
+            )
+        return self._conn
+
+    def subscribe(self, user_id):
+        queue = asyncio.Queue(self.queue_size)
+        self._subscribers.setdefault(str(user_id), set()).add(queue)
+        self.ensure_running()
+        return queue
+
+    def unsubscribe(self, user_id, queue):
+        queues = self._subscribers.get(str(user_id))
+        if queues is not None:
+            queues.discard(queue)
+            if not queues:
+                del self._subscribers[str(user_id)]
+
+    def listen(self, callback, active):
+        """注册监听：active()为真时保持同步，其他worker的事件以 callback(用户ID, 事件) 通知"""
+        self._listeners.append((callback, active))
+
+    def _listening(self):
+        return any(active() for _, active in self._listeners)
+
+    def publish(self, user_id, event):
+        """分发给本worker的连接，并排队写入事件表供其他worker分发"""
+        user_id = str(user_id)
+        self._deliver(user_id, event)
+        self._pending.append((user_id, json.dumps(event, ensure_ascii=False)))
+        self.ensure_running()
+
+    def ensure_running(self, since=None):
+        """有连接、待写入事件或监听方需要时启动同步任务
+
+        since: 需要分发的事件的最早写入时间（默认为启动时）
+        """
+        if self._task is not None:
+            if since is not None and self._last_seq is None:
+                self._started_at = min(self._started_at, since)
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # 不在事件循环中（如离线回放线程），由下次启动的任务写入
+            return
+        self._started_at = time.time() if since is None else since
+        self._task = loop.create_task(self._run(), name="user_events")
+
+    def _deliver(self, user_id, event):
+        for queue in self._subscribers.get(user_id, ()):
+            # 连接消费过慢时丢弃最旧的事件
+            if queue.full():
+                queue.get_nowait()
+            queue.put_nowait(event)
+
+    def _sync(self, pending, poll):
+        """写入本worker的事件并读取其他worker的新事件（在线程中执行）"""
+        conn = self._connect()
+        now = time.time()
+        if pending:
+            conn.executemany(
+                "INSERT INTO events (worker, user_id, payload, created_at) VALUES (?, ?, ?, ?)",
+                [(self.worker, user_id, payload, now) for user_id, payload in pending],
+            )
+        if not poll:
+            # 没有连接时不需要读取，只记录当前位置
+            self._last_seq = conn.execute(
+                "SELECT COALESCE(MAX(seq), 0) FROM events"
+            ).fetchone()[0]
+            return []
+        if self._last_seq is None:
+            # 任务刚启动：从启动前的位置开始，首次同步前其他worker写入的事件不会漏掉
+            self._last_seq = conn.execute(
+                "SELECT COALESCE(MAX(seq), 0) FROM events WHERE created_at < ?",
+                (self._started_at,),
+            ).fetchone()[0]
+        rows = conn.execute(
+            "SELECT seq, user_id, payload FROM events WHERE seq > ? AND worker != ? ORDER BY seq",
+            (self._last_seq, self.worker),
+        ).fetchall()
+        if rows:
+            self._last_seq = rows[-1][0]
+        return rows
+
+    def prune(self):
+        self._connect().execute(
+            "DELETE FROM events WHERE created_at < ?", (time.time() - self.retention,)
+        )
+
+    async def _run(self):
+        """同步任务：批量写入事件表并分发其他worker的事件，没有连接、待写入事件与监听方时退出"""
+        try:
+            while self._subscribers or self._pending or self._listening():
+                await asyncio.sleep(self.poll_interval)
+                await self._flush()
+        finally:
+            # 退出后不再跟踪事件表位置，重新启动时从启动时的位置开始分发
+            self._task = None
+            self._last_seq = None
+
+    async def _flush(self):
+        pending, self._pending = self._pending, []
+        try:
+            poll = bool(self._subscribers) or self._listening()
+            rows = await asyncio.to_thread(self._sync, pending, poll)
+            for _, user_id, payload in rows:
+                event = json.loads(payload)
+                if user_id in self._subscribers:
+                    self._deliver(user_id, event)
+                for callback, _ in self._listeners:
+                    callback(user_id, event)
+            if time.monotonic() - self._last_prune >= self.retention:
+                await asyncio.to_thread(self.prune)
+                self._last_prune = time.monotonic()
+        except Exception as e:
+            logger.error(f"用户事件同步失败, error: {e}")
+
+    async def close(self):
+        """worker停止时结束同步任务并写入剩余事件"""
+        if self._task is not None:
+            self._task.cancel()
+        if self._pending:
+            await self._flush()
+
+
+# 进程内单例
+event_bus = EventBus(**EVENT_CONFIG)
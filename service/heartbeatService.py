@@ -0,0 +1,43 @@
+"""
+闸机心跳聚合
+心跳只在内存中记录设备最后活跃时间，由定时任务合并为一条批量UPDATE落库
+"""
+
+
+class HeartbeatAggregator:
+    """按设备号合并心跳时间"""
+
+    def __init__(self):
+        # 待落库的 设备号 -> 最后活跃时间
+        self._pending = {}
+        # 数据库中已存在的设备号
+        self._known = set()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def is_known(self, device_no):
+        return device_no in self._known
+
+    def mark_known(self, device_no):
+        self._known.add(device_no)
+
+    def load_known(self, device_nos):
+        self._known = {device_no for device_no in device_nos if device_no}
+
+    def record(self, device_no, seen_at):
+        self._pending[device_no] = seen_at
+
+    def drain(self):
+        """取出全部待落库心跳"""
+        pending, self._pending = self._pending, {}
+        return pending
+
+    def restore(self, pending):
+        """落库失败时放回，保留期间收到的更新的心跳"""
+        for device_no, seen_at in pending.items():
+            self._pending.setdefault(device_no, seen_at)
+
+
+# 进程内单例
+heartbeat_aggregator = HeartbeatAggregator()
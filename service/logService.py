@@ -0,0 +1,177 @@
+"""
+日志配置
+日志先进入loguru队列，由后台线程批量写入文件，不在事件循环中进行磁盘IO；
+闸机等高频错误日志按类型限流，避免异常扫码洪峰带来日志洪峰
+"""
+
+import glob
+import gzip
+import os
+import shutil
+import sys
+import threading
+import time
+from datetime import datetime
+from loguru import logger
+from service.workerService import get_worker_name
+
+
+class BatchedFileSink:
+    """批量写入的日志文件，按大小或时间轮转并gzip压缩，由loguru后台线程调用"""
+
+    def __init__(
+        self,
+        path,
+        rotation_bytes=100 * 1024 * 1024,
+        rotation_interval=86400,
+        retention=14,
+        batch_bytes=64 * 1024,
+        flush_interval=1.0,
+    ):
+        self.path = path
+        self.rotation_bytes = rotation_bytes
+        self.rotation_interval = rotation_interval
+        self.retention = retention
+        self.batch_bytes = batch_bytes
+        self.flush_interval = flush_interval
+        self._buffer = []
+        self._buffer_size = 0
+        self._lock = threading.Lock()
+        self._open()
+        # 定时刷盘，保证低流量时日志也能及时落盘
+        self._stopped = threading.Event()
+        self._flusher = threading.Thread(
+            target=self._flush_forever, name="log-flusher", daemon=True
+        )
+        self._flusher.start()
+
+    def _open(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._file = open(self.path, "a", encoding="utf-8")
+        self._opened_at = time.time()
+
+    def write(self, message):
+        with self._lock:
+            self._buffer.append(message)
+            self._buffer_size += len(message)
+            if self._buffer_size >= self.batch_bytes:
+                self._flush()
+
+    def stop(self):
+        self._stopped.set()
+        self._flusher.join()
+        with self._lock:
+            self._flush()
+            self._file.close()
+
+    def _flush_forever(self):
+        while not self._stopped.wait(self.flush_interval):
+            with self._lock:
+                self._flush()
+
+    def _flush(self):
+        if self._buffer:
+            self._file.write("".join(self._buffer))
+            self._file.flush()
+            self._buffer.clear()
+            self._buffer_size = 0
+        if self._file.tell() >= self.rotation_bytes or (
+            self._file.tell()
+            and time.time() - self._opened_at >= self.rotation_interval
+        ):
+            self._rotate()
+
+    def _rotate(self):
+        self._file.close()
+        rotated = f"{self.path}.{datetime.now():%Y%m%d-%H%M%S}"
+        os.replace(self.path, rotated)
+        self._open()
+
+        # 压缩轮转出的文件
+        with open(rotated, "rb") as src, gzip.open(rotated + ".gz", "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.remove(rotated)
+
+        # 只保留最近的若干个压缩文件
+        archives = sorted(glob.glob(f"{self.path}.*.gz"))
+        for archive in archives[: max(0, len(archives) - self.retention)]:
+            os.remove(archive)
+
+
+class RateLimitFilter:
+    """按rate_key限流，每个时间窗口内同类日志最多输出limit条，超出部分丢弃并在下个窗口汇总"""
+
+    def __init__(self, limit=20, window=1.0):
+        self.limit = limit
+        self.window = window
+        # rate_key -> [窗口开始时间, 已输出数, 已丢弃数]
+        self._windows = {}
+
+    def __call__(self, record):
+        extra = record["extra"]
+        key = extra.get("rate_key")
+        if key is None:
+            return True
+        # 同一条日志会依次经过多个输出，只判断一次
+        allowed = extra.get("_rate_allowed")
+        if allowed is not None:
+            return allowed
+
+        now = time.monotonic()
+        state = self._windows.get(key)
+        if state is None or now - state[0] >= self.window:
+            dropped = state[2] if state else 0
+            if dropped:
+                record["message"] += f" (上一窗口另有{dropped}条同类日志被限流丢弃)"
+            state = self._windows[key] = [now, 0, 0]
+
+        allowed = state[1] < self.limit
+        if allowed:
+            state[1] += 1
+        else:
+            state[2] += 1
+        extra["_rate_allowed"] = allowed
+        return allowed
+
+
+def setup_logging(
+    path="gate.log",
+    level="INFO",
+    rotation_bytes=100 * 1024 * 1024,
+    rotation_interval=86400,
+    retention=14,
+    batch_bytes=64 * 1024,
+    flush_interval=1.0,
+    rate_limit=20,
+    rate_window=1.0,
+):
+    """替换loguru默认输出：控制台与文件均通过队列异步写入"""
+    # 多worker各自写入独立文件，避免多进程同时轮转同一个文件
+    worker = get_worker_name()
+    if worker:
+        root, ext = os.path.splitext(path)
+        path = f"{root}.{worker}{ext}"
+
+    rate_filter = RateLimitFilter(limit=rate_limit, window=rate_window)
+    # 队列使用spawn上下文，避免锁定全局启动方式（Sanic多worker要求spawn）
+    options = {
+        "level": level,
+        "enqueue": True,
+        "context": "spawn",
+        "filter": rate_filter,
+    }
+    logger.remove()
+    logger.add(sys.stderr, **options)
+    logger.add(
+        BatchedFileSink(
+            path,
+            rotation_bytes=rotation_bytes,
+            rotation_interval=rotation_interval,
+            retention=retention,
+            batch_bytes=batch_bytes,
+            flush_interval=flush_interval,
+        ),
+        **options,
+    )
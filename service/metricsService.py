@@ -0,0 +1,225 @@
+"""
+运行指标
+进程内记录计数器与延迟直方图，各worker定时将快照写入共享目录，/metrics 汇总所有worker后以Prometheus文本格式输出
+"""
+
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from config import METRICS_CONFIG
+from service.workerService import WorkerSnapshots
+from functools import wraps
+
+# 延迟直方图分桶（秒）
+DEFAULT_BUCKETS = (
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+)
+
+
+class MetricsRegistry:
+    """进程内指标注册表"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # 指标名 -> (类型, 说明, 标签名)
+        self._meta = {}
+        # (指标名, 标签值) -> 数值
+        self._values = {}
+        # (指标名, 标签值) -> [各分桶计数..., +Inf计数, 总和]
+        self._histograms = {}
+
+    def describe(self, name, kind, help, labelnames=()):
+        """注册指标，kind为 counter / gauge / histogram"""
+        self._meta[name] = (kind, help, tuple(labelnames))
+
+    def inc(self, name, labels=(), amount=1):
+        key = (name, labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    def set(self, name, labels=(), value=0):
+        self._values[(name, labels)] = value
+
+    def observe(self, name, value, labels=()):
+        key = (name, labels)
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            histogram = self._histograms[key] = [0] * (len(self.buckets) + 2)
+        histogram[bisect_left(self.buckets, value)] += 1
+        histogram[-1] += value
+
+    def snapshot(self):
+        """导出可JSON序列化的快照"""
+        return {
+            "values": [
+                [name, list(labels), value]
+                for (name, labels), value in self._values.items()
+            ],
+            "histograms": [
+                [name, list(labels), histogram]
+                for (name, labels), histogram in self._histograms.items()
+            ],
+        }
+
+    def render(self, snapshots):
+        """汇总多个快照并输出Prometheus文本格式"""
+        values = {}
+        histograms = {}
+        for snapshot in snapshots:
+            for name, labels, value in snapshot.get("values", []):
+                key = (name, tuple(labels))
+                values[key] = values.get(key, 0) + value
+            for name, labels, histogram in snapshot.get("histograms", []):
+                key = (name, tuple(labels))
+                merged = histograms.setdefault(key, [0] * len(histogram))
+                for i, count in enumerate(histogram):
+                    merged[i] += count
+
+        lines = []
+        for name, (kind, help, labelnames) in sorted(self._meta.items()):
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == "histogram":
+                for (metric, labels), histogram in sorted(histograms.items()):
+                    if metric != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip([*self.buckets, "+Inf"], histogram[:-1]):
+                        cumulative += count
+                        le = _format_labels(labelnames, labels, ("le", bound))
+                        lines.append(f"{name}_bucket{le} {cumulative}")
+                    label_text = _format_labels(labelnames, labels)
+                    lines.append(f"{name}_sum{label_text} {histogram[-1]}")
+                    lines.append(f"{name}_count{label_text} {cumulative}")
+            else:
+                for (metric, labels), value in sorted(values.items()):
+                    if metric == name:
+                        lines.append(
+                            f"{name}{_format_labels(labelnames, labels)} {value}"
+                        )
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labelnames, labels, extra=None):
+    pairs = list(zip(labelnames, labels))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    text = ",".join(f'{key}="{_escape(value)}"' for key, value in pairs)
+    return "{" + text + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class SharedMetrics:
+    """多worker指标汇总：每个worker将快照写入共享目录的独立文件"""
+
+    def __init__(self, registry, directory="data/metrics"):
+        self.registry = registry
+        self.snapshots = WorkerSnapshots(directory)
+
+    def clear(self):
+        """主进程启动时清理上次运行的快照"""
+        self.snapshots.clear()
+
+    def publish(self):
+        """原子写入当前worker的快照"""
+        self.snapshots.write(self.registry.snapshot())
+
+    def render(self):
+        """读取其他worker的快照并与当前worker实时数据汇总"""
+        snapshots = [self.registry.snapshot(), *self.snapshots.read_others()]
+        return self.registry.render(snapshots)
+
+
+# 进程内单例
+metrics = MetricsRegistry()
+shared_metrics = SharedMetrics(metrics, METRICS_CONFIG["dir"])
+
+metrics.describe(
+    "http_request_duration_seconds",
+    "histogram",
+    "接口耗时",
+    ("route", "method", "status"),
+)
+metrics.describe(
+    "db_call_duration_seconds",
+    "histogram",
+    "模型方法（数据库调用）耗时",
+    ("call", "outcome"),
+)
+metrics.describe(
+    "wechat_call_duration_seconds",
+    "histogram",
+    "微信接口调用耗时",
+    ("call", "outcome"),
+)
+metrics.describe(
+    "cache_requests_total",
+    "counter",
+    "进程内缓存命中/未命中次数",
+    ("cache", "result"),
+)
+metrics.describe(
+    "gate_shed_total",
+    "counter",
+    "闸机请求被限流或降载的次数",
+    ("endpoint", "reason"),
+)
+metrics.describe(
+    "pay_reconcile_total",
+    "counter",
+    "付款中订单对账结果",
+    ("result",),
+)
+metrics.describe(
+    "gate_admission_total",
+    "counter",
+    "闸机放行/拒绝次数",
+    ("reader", "result", "reason"),
+)
+
+
+@contextmanager
+def timer(histogram, call):
+    """记录代码块耗时与成败"""
+    start = time.perf_counter()
+    outcome = "ok"
+    try:
+        yield
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        metrics.observe(histogram, time.perf_counter() - start, (call, outcome))
+
+
+def timed(histogram, call=None):
+    """记录异步函数耗时与成败的装饰器"""
+
+    def decorator(func):
+        name = call or func.__qualname__
+
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            with timer(histogram, name):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,198 @@
+"""
+支付通知队列
+回调只做签名校验并写入本地持久化队列后立即应答，由后台任务幂等地更新订单并创建入闸记录；
+队列以 out_trade_no 去重，微信重复通知不会重复处理
+"""
+
+import asyncio
+import os
+import threading
+import time
+import uuid
+from loguru import logger
+from tool import connectSqlite
+
+
+class PayNotifyQueue:
+    """基于本地SQLite文件的支付通知队列，多个worker进程共享"""
+
+    def __init__(
+        self, path, lease=60, max_attempts=10, retry_delay=2, keep_done=7 * 86400
+    ):
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self.keep_done = keep_done
+        self._lock = threading.Lock()
+        # 应答前需确保已落盘
+        self._conn = connectSqlite(path, synchronous="FULL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS pay_notify ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "out_trade_no TEXT NOT NULL UNIQUE, "
+            "transaction_id TEXT NOT NULL, "
+            "openid TEXT, "
+            "status TEXT NOT NULL DEFAULT 'pending', "
+            "attempts INTEGER NOT NULL DEFAULT 0, "
+            "next_at REAL NOT NULL, "
+            "claim_token TEXT, "
+            "claimed_at REAL, "
+            "last_error TEXT, "
+            "created_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_pay_notify_status_next_at "
+            "ON pay_notify (status, next_at)"
+        )
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def enqueue(self, out_trade_no, transaction_id, openid):
+        """写入通知，返回是否需要处理
+
+        同一订单号待处理或已完成时忽略；已失败（超过最大重试次数）的重新置为待处理，
+        微信重发通知或对账发现已支付时可再次处理
+        """
+        now = time.time()
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT INTO pay_notify "
+                "(out_trade_no, transaction_id, openid, next_at, created_at) "
+                "VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT(out_trade_no) DO UPDATE SET status = 'pending', "
+                "attempts = 0, next_at = excluded.next_at, "
+                "claim_token = NULL, claimed_at = NULL "
+                "WHERE status = 'failed'",
+                (out_trade_no, transaction_id, openid, now, now),
+            )
+            return cursor.rowcount == 1
+
+    def claim(self, limit=10):
+        """领取到期的待处理通知，租约过期未完成的通知可被重新领取"""
+        now = time.time()
+        token = uuid.uuid4().hex
+        self._execute(
+            "UPDATE pay_notify SET claim_token = ?, claimed_at = ? WHERE id IN ("
+            "SELECT id FROM pay_notify WHERE status = 'pending' AND next_at <= ? "
+            "AND (claimed_at IS NULL OR claimed_at < ?) ORDER BY id LIMIT ?)",
+            (token, now, now, now - self.lease, limit),
+        )
+        return self._execute(
+            "SELECT id, out_trade_no, transaction_id, openid, attempts "
+            "FROM pay_notify WHERE claim_token = ?",
+            (token,),
+        )
+
+    def complete(self, notify_id):
+        self._execute(
+            "UPDATE pay_notify SET status = 'done', claim_token = NULL WHERE id = ?",
+            (notify_id,),
+        )
+
+    def retry(self, notify_id, attempts, error):
+        """处理失败后按指数退避重试，超过最大次数标记为失败"""
+        attempts += 1
+        status = "failed" if attempts >= self.max_attempts else "pending"
+        delay = min(self.retry_delay * 2 ** (attempts - 1), 300)
+        self._execute(
+            "UPDATE pay_notify SET status = ?, attempts = ?, next_at = ?, "
+            "claim_token = NULL, claimed_at = NULL, last_error = ? WHERE id = ?",
+            (status, attempts, time.time() + delay, str(error), notify_id),
+        )
+        return status
+
+    def prune(self):
+        """清理已完成的历史通知"""
+        self._execute(
+            "DELETE FROM pay_notify WHERE status = 'done' AND created_at < ?",
+            (time.time() - self.keep_done,),
+        )
+
+
+class PayNotifyWorker:
+    """后台处理支付通知，handler为处理单条通知的协程函数"""
+
+    def __init__(self, queue, handler, concurrency=2, poll_interval=1.0, batch_size=10):
+        self.queue = queue
+        self.handler = handler
+        self.concurrency = concurrency
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self._wakeup = None
+
+    async def enqueue(self, out_trade_no, transaction_id, openid):
+        """持久化写入队列并唤醒本进程的处理任务"""
+        created = await asyncio.to_thread(
+            self.queue.enqueue, out_trade_no, transaction_id, openid
+        )
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return created
+
+    async def run(self):
+        """启动处理任务，随应用停止被取消"""
+        self._wakeup = asyncio.Event()
+        await asyncio.gather(
+            self._prune_forever(),
+            *[self._run_one() for _ in range(self.concurrency)],
+        )
+
+    async def _prune_forever(self, interval=3600):
+        while True:
+            try:
+                await asyncio.to_thread(self.queue.prune)
+            except Exception as e:
+                logger.error(f"支付通知队列清理失败, error: {e}")
+            await asyncio.sleep(interval)
+
+    async def _run_one(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                items = await asyncio.to_thread(self.queue.claim, self.batch_size)
+            except Exception as e:
+                logger.error(f"支付通知队列读取失败, error: {e}")
+                items = []
+
+            if not items:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            for notify_id, out_trade_no, transaction_id, openid, attempts in items:
+                try:
+                    await self.handler(out_trade_no, transaction_id, openid)
+                    await asyncio.to_thread(self.queue.complete, notify_id)
+                except Exception as e:
+                    status = await asyncio.to_thread(
+                        self.queue.retry, notify_id, attempts, e
+                    )
+                    logger.error(
+                        f"支付通知处理失败, out_trade_no: {out_trade_no}, "
+                        f"status: {status}, error: {e}"
+                    )
+
+
+def create_pay_notify_worker(
+    handler,
+    path="data/pay_notify.db",
+    concurrency=2,
+    poll_interval=1.0,
+    lease=60,
+    max_attempts=10,
+    retry_delay=2,
+):
+    """根据配置创建支付通知处理器"""
+    queue = PayNotifyQueue(
+        os.path.abspath(path),
+        lease=lease,
+        max_attempts=max_attempts,
+        retry_delay=retry_delay,
+    )
+    return PayNotifyWorker(
+        queue, handler, concurrency=concurrency, poll_interval=poll_interval
+    )
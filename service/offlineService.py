@@ -0,0 +1,406 @@
+"""
+闸机离线放行
+数据库超出延迟预算或不可用时，根据本地SQLite中的未离开二维码快照判断是否放行，
+进出事件写入本地日志，数据库恢复后按顺序回放到 enter_log
+
+快照由同一机器的worker共享，离线放行同时更新快照中的状态，其他worker离线判断时可见；
+处于在线状态的worker以数据库为准，其他worker离线放行的进入在回放前对其不可见
+"""
+
+import asyncio
+import threading
+import time
+from loguru import logger
+from tortoise.exceptions import DBConnectionError, OperationalError
+from tool import connectSqlite, getNowTime
+from models import EnterLog, qr_token_signer
+from service.admissionService import AdmissionState, admission_index
+from service.presenceService import presence_tracker
+from service.workerService import get_worker_id
+
+# 视为数据库不可用的异常
+DB_UNAVAILABLE_ERRORS = (
+    asyncio.TimeoutError,
+    DBConnectionError,
+    OperationalError,
+    ConnectionError,
+    OSError,
+)
+
+
+def _newer(a, b):
+    if a is None or (b is not None and b.synced_at > a.synced_at):
+        return b
+    return a
+
+
+class OfflineStore:
+    """本地SQLite：未离开二维码快照与离线进出日志，多个worker进程共享"""
+
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        self._conn = connectSqlite(path)
+        self._conn.executescript(
+            "CREATE TABLE IF NOT EXISTS admission ("
+            "id INTEGER PRIMARY KEY, qrcode TEXT NOT NULL UNIQUE, "
+            "user_id INTEGER, order_id INTEGER, "
+            "entered INTEGER NOT NULL, left INTEGER NOT NULL, gate TEXT, "
+            "synced_at REAL);"
+            "CREATE TABLE IF NOT EXISTS journal ("
+            "seq INTEGER PRIMARY KEY AUTOINCREMENT, worker TEXT NOT NULL, "
+            "enter_log_id INTEGER NOT NULL, action TEXT NOT NULL, "
+            "device_no TEXT, at TEXT NOT NULL);"
+            "CREATE INDEX IF NOT EXISTS idx_journal_worker ON journal (worker, seq);"
+            "CREATE INDEX IF NOT EXISTS idx_journal_enter_log ON journal (enter_log_id, seq);"
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value REAL);"
+        )
+        # 兼容未记录进入闸机、更新时间的旧快照表
+        columns = [row[1] for row in self._conn.execute("PRAGMA table_info(admission)")]
+        if "gate" not in columns:
+            self._conn.execute("ALTER TABLE admission ADD COLUMN gate TEXT")
+        if "synced_at" not in columns:
+            self._conn.execute("ALTER TABLE admission ADD COLUMN synced_at REAL")
+
+    def _execute(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).fetchall()
+
+    def _execute_count(self, sql, params=()):
+        with self._lock:
+            return self._conn.execute(sql, params).rowcount
+
+    def snapshot_due(self, interval):
+        """距上次（任一worker）刷新快照是否已超过interval秒"""
+        rows = self._execute("SELECT value FROM meta WHERE key = 'snapshot_at'")
+        return not rows or rows[0][0] < time.time() - interval
+
+    def replace_snapshot(self, states, read_at):
+        """用read_at时读取的数据库状态替换快照
+
+        保留此后离线放行更新的记录，以及离线日志尚未回放（数据库中还不是最新）的记录
+        """
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "DELETE FROM admission "
+                    "WHERE (synced_at IS NULL OR synced_at < ?) "
+                    "AND id NOT IN (SELECT enter_log_id FROM journal)",
+                    (read_at,),
+                )
+                self._conn.executemany(
+                    "INSERT OR IGNORE INTO admission VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    [
+                        (
+                            s.id,
+                            s.qrcode,
+                            s.user_id,
+                            s.order_id,
+                            s.entered,
+                            s.left,
+                            s.gate,
+                            s.synced_at,
+                        )
+                        for s in states
+                        if s.qrcode
+                    ],
+                )
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO meta VALUES ('snapshot_at', ?)",
+                    (time.time(),),
+                )
+                self._conn.execute("COMMIT")
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def get(self, qrcode=None, enter_log_id=None):
+        if enter_log_id is not None:
+            rows = self._execute(
+                "SELECT * FROM admission WHERE id = ?", (enter_log_id,)
+            )
+        else:
+            rows = self._execute("SELECT * FROM admission WHERE qrcode = ?", (qrcode,))
+        if not rows:
+            return None
+        id, qrcode, user_id, order_id, entered, left, gate, synced_at = rows[0]
+        return AdmissionState(
+            id,
+            qrcode,
+            user_id,
+            order_id,
+            bool(entered),
+            bool(left),
+            gate,
+            synced_at or 0,
+        )
+
+    def record(self, state, worker, action, device_no, at):
+        """在一个事务中更新快照状态并写入离线日志，返回日志序号"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.execute(
+                    "UPDATE admission SET entered = ?, left = ?, gate = ?, "
+                    "synced_at = ? WHERE id = ?",
+                    (state.entered, state.left, state.gate, state.synced_at, state.id),
+                )
+                seq = self._conn.execute(
+                    "INSERT INTO journal (worker, enter_log_id, action, device_no, at) "
+                    "VALUES (?, ?, ?, ?, ?)",
+                    (worker, state.id, action, device_no, at),
+                ).lastrowid
+                self._conn.execute("COMMIT")
+                return seq
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def pending_journal(self, worker, limit):
+        return self._execute(
+            "SELECT seq, worker, enter_log_id, action, device_no, at FROM journal "
+            "WHERE worker = ? ORDER BY seq LIMIT ?",
+            (worker, limit),
+        )
+
+    def journal_for(self, qrcode=None, enter_log_id=None):
+        """某个二维码尚未回放的离线日志（所有worker写入的）"""
+        if enter_log_id is None:
+            rows = self._execute("SELECT id FROM admission WHERE qrcode = ?", (qrcode,))
+            if not rows:
+                return []
+            enter_log_id = rows[0][0]
+        return self._execute(
+            "SELECT seq, worker, enter_log_id, action, device_no, at FROM journal "
+            "WHERE enter_log_id = ? ORDER BY seq",
+            (enter_log_id,),
+        )
+
+    def delete_journal(self, seq):
+        """删除日志，返回是否删除（可能已被回放删除）"""
+        return self._execute_count("DELETE FROM journal WHERE seq = ?", (seq,)) > 0
+
+    def count_journal(self, worker):
+        return self._execute(
+            "SELECT COUNT(*) FROM journal WHERE worker = ?", (worker,)
+        )[0][0]
+
+
+class OfflineGate:
+    """数据库超时/不可用时切换到本地判断，并在恢复后回放离线事件"""
+
+    def __init__(
+        self,
+        path="data/offline_gate.db",
+        db_budget=0.5,
+        offline_hold=5.0,
+        snapshot_interval=60.0,
+        replay_batch=200,
+    ):
+        self.db_budget = db_budget
+        self.offline_hold = offline_hold
+        self.snapshot_interval = snapshot_interval
+        self.replay_batch = replay_batch
+        self.store = OfflineStore(path)
+        # 每个worker只回放自己写入的日志，worker重启后名称不变
+        self.worker = get_worker_id()
+        self.pending = self.store.count_journal(self.worker)
+        self._offline_until = 0
+        self._replay_lock = asyncio.Lock()
+
+    @property
+    def offline(self):
+        return time.monotonic() < self._offline_until
+
+    async def decide(self, online, payload, device_no, action, slot=None):
+        """优先在延迟预算内走数据库，超时或不可用时本地判断，返回 online / offline
+
+        payload: 解析后的二维码内容（QrPayload）
+
+        slot: 数据库并发额度，排队等待额度的时间不计入延迟预算；
+        超出预算的数据库操作不取消（避免连接在协议中途被放回连接池），由其完成结果决定离线日志去留；
+        离线判断拒绝时等待该操作完成，以数据库结果答复
+        """
+        in_flight = None
+        if not self.offline:
+            if slot is not None:
+                await slot.acquire()
+            task = asyncio.ensure_future(online())
+            if slot is not None:
+                task.add_done_callback(lambda _: slot.release())
+            done, _ = await asyncio.wait({task}, timeout=self.db_budget)
+            if done:
+                try:
+                    task.result()
+                    return "online"
+                except DB_UNAVAILABLE_ERRORS as e:
+                    logger.error(f"数据库不可用，切换离线放行, error: {e!r}")
+            else:
+                logger.error(f"数据库超出延迟预算 {self.db_budget}s，切换离线放行")
+                # 离线判断拒绝时也需取回结果，避免未处理异常告警
+                task.add_done_callback(lambda t: t.cancelled() or t.exception())
+                in_flight = task
+            self._offline_until = time.monotonic() + self.offline_hold
+
+        try:
+            await self.decide_offline(payload, device_no, action, in_flight)
+        except Exception:
+            if in_flight is None:
+                raise
+            # 离线判断拒绝时数据库操作仍可能提交本次进出，等待其结果再答复闸机，
+            # 避免拒绝后数据库记录了进出、此后的扫码都被拒绝
+            await asyncio.wait({in_flight})
+            if in_flight.exception() is None:
+                return "online"
+            if not isinstance(in_flight.exception(), DB_UNAVAILABLE_ERRORS):
+                raise in_flight.exception()
+            raise
+        return "offline"
+
+    async def decide_offline(self, payload, device_no, action, in_flight=None):
+        """根据内存索引或本地快照判断，放行后写入离线日志
+
+        in_flight: 超出预算仍在执行的数据库操作，成功时数据库已记录本次进出，删除对应日志；
+        失败时保留日志待回放，并按离线放行计入在场人数、推送事件
+        """
+        qrcode = payload.value
+        state = await self._get_state(payload)
+        if action == "enter":
+            EnterLog._check_enter(state, qrcode)
+            state.entered = True
+            state.gate = device_no
+        else:
+            EnterLog._check_leave(state, qrcode)
+            state.left = True
+        state.touch()
+
+        at = getNowTime()
+        seq = await asyncio.to_thread(
+            self.store.record, state, self.worker, action, device_no, str(at)
+        )
+        self.pending += 1
+        admission_index.put(state)
+
+        if in_flight is None:
+            self._apply_effects(state, action, at)
+            return
+
+        def settle(task):
+            if not task.cancelled() and task.exception() is None:
+                asyncio.ensure_future(self._forget(seq))
+            else:
+                self._apply_effects(state, action, at)
+
+        in_flight.add_done_callback(settle)
+
+    @staticmethod
+    def _apply_effects(state, action, at):
+        """离线放行后的内存状态：在场人数、二维码缓存与用户事件"""
+        if action == "enter":
+            presence_tracker.entered(state.gate)
+        else:
+            presence_tracker.left(state.gate)
+        EnterLog.invalidate_qrcode_cache(state.user_id, state.order_id)
+        EnterLog.publish_state_event(state, action, at)
+
+    async def _forget(self, seq):
+        """超时的数据库操作最终成功，对应的离线日志不再回放"""
+        try:
+            if await asyncio.to_thread(self.store.delete_journal, seq):
+                self.pending -= 1
+        except Exception as e:
+            logger.error(f"离线日志删除失败, seq: {seq}, error: {e!r}")
+
+    async def _get_state(self, payload):
+        """内存索引与本地快照中较新的一份（快照包含其他worker的离线放行）"""
+        qrcode = payload.value
+        if payload.is_token and qr_token_signer.can_verify:
+            token = qr_token_signer.verify(qrcode)
+            state = _newer(
+                admission_index.get_by_id(token.enter_log_id),
+                await asyncio.to_thread(
+                    self.store.get, enter_log_id=token.enter_log_id
+                ),
+            )
+            if state and (state.user_id, state.order_id) != (
+                token.user_id,
+                token.order_id,
+            ):
+                return None
+            return state
+        return _newer(
+            admission_index.get(qrcode),
+            await asyncio.to_thread(self.store.get, qrcode=qrcode),
+        )
+
+    async def replay(self, budget=None):
+        """按顺序回放本worker的离线日志，冲突（已被处理）的事件记录后丢弃
+
+        budget: 每批之间检查耗时，超出后留待下次回放；执行中的数据库操作不取消
+        """
+        if not self.pending:
+            return
+        start = time.monotonic()
+        async with self._replay_lock:
+            while self.pending:
+                if budget is not None and time.monotonic() - start >= budget:
+                    return
+                entries = await asyncio.to_thread(
+                    self.store.pending_journal, self.worker, self.replay_batch
+                )
+                if not entries:
+                    self.pending = 0
+                    break
+                await self._apply_journal(entries)
+
+    async def replay_for(self, payload):
+        """闸机请求前只回放该二维码的离线日志，使本次数据库判断包含离线期间的进出
+
+        本worker没有待回放日志时不查询；其余日志由后台任务分批回放
+        """
+        if not self.pending:
+            return
+        qrcode = payload.value
+        if payload.is_token and qr_token_signer.can_verify:
+            token = qr_token_signer.verify(qrcode)
+            entries = await asyncio.to_thread(
+                self.store.journal_for, enter_log_id=token.enter_log_id
+            )
+        else:
+            entries = await asyncio.to_thread(self.store.journal_for, qrcode=qrcode)
+        if entries:
+            await self._apply_journal(entries)
+
+    async def _apply_journal(self, entries):
+        for seq, worker, enter_log_id, action, device_no, at in entries:
+            updated = await EnterLog.apply_offline_event(
+                enter_log_id, action, device_no, at
+            )
+            if not updated:
+                logger.warning(
+                    f"离线事件与数据库状态冲突已丢弃, enter_log_id: {enter_log_id}, "
+                    f"action: {action}, at: {at}"
+                )
+            deleted = await asyncio.to_thread(self.store.delete_journal, seq)
+            if deleted and worker == self.worker:
+                self.pending -= 1
+
+    async def refresh_snapshot(self):
+        """从数据库刷新未离开二维码快照（多个worker间按间隔只刷新一次）"""
+        if not await asyncio.to_thread(self.store.snapshot_due, self.snapshot_interval):
+            return
+        read_at = time.time()
+        states = await EnterLog.get_open_admission_states()
+        await asyncio.to_thread(self.store.replace_snapshot, states, read_at)
+
+    async def run(self, interval=1.0):
+        """后台任务：数据库恢复后回放日志并定时刷新快照"""
+        while True:
+            await asyncio.sleep(interval)
+            if self.offline:
+                continue
+            try:
+                await self.replay(budget=max(self.db_budget, 5))
+                await self.refresh_snapshot()
+            except Exception as e:
+                logger.error(f"离线日志回放或快照刷新失败, error: {e!r}")
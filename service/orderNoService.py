@@ -0,0 +1,51 @@
+"""
+订单号生成
+格式（24位数字，符合微信支付商户订单号要求）:
+    yyyyMMddHHmmss(14) + 毫秒(3) + 节点号(2) + worker序号(2) + 毫秒内序列号(3)
+不查询数据库也不加锁，节点号与worker序号保证多机多进程间不重复
+"""
+
+import time
+from service.workerService import get_worker_index
+
+# 每毫秒最多生成的订单号数量
+SEQUENCE_LIMIT = 1000
+
+
+class OrderNoGenerator:
+    """雪花算法风格的订单号生成器，只在事件循环线程中调用"""
+
+    def __init__(self, node_id=0, worker_index=None):
+        if worker_index is None:
+            worker_index = get_worker_index()
+        if not 0 <= node_id < 100 or not 0 <= worker_index < 100:
+            raise ValueError(
+                f"节点号与worker序号需在0-99之间: {node_id}, {worker_index}"
+            )
+        self._worker = f"{node_id:02d}{worker_index:02d}"
+        self._last_ms = 0
+        self._sequence = 0
+        # 缓存当前秒的时间前缀
+        self._second = None
+        self._second_prefix = ""
+
+    def generate(self):
+        now_ms = time.time_ns() // 1_000_000
+        if now_ms > self._last_ms:
+            self._last_ms = now_ms
+            self._sequence = 0
+        else:
+            # 同一毫秒内或时钟回拨时沿用上次的时间继续递增
+            self._sequence += 1
+            if self._sequence >= SEQUENCE_LIMIT:
+                # 当前毫秒序列号用尽，借用下一毫秒
+                self._last_ms += 1
+                self._sequence = 0
+
+        second, millisecond = divmod(self._last_ms, 1000)
+        if second != self._second:
+            self._second = second
+            self._second_prefix = time.strftime("%Y%m%d%H%M%S", time.localtime(second))
+        return (
+            f"{self._second_prefix}{millisecond:03d}{self._worker}{self._sequence:03d}"
+        )
@@ -0,0 +1,133 @@
+"""
+在场人数与闸机在线状态
+进出闸与心跳时在内存中增量计数，不扫描数据表：
+主进程启动时从数据库计算基线，各worker定时将增量写入共享目录，并在后台汇总 基线 + 其他worker增量；
+查询只合并内存中的汇总与当前worker的增量，不读取文件
+"""
+
+import asyncio
+import time
+from bisect import bisect_left
+from config import PRESENCE_CONFIG
+from service.workerService import WorkerSnapshots
+
+# 进入设备未知的记录（如离线放行前的历史数据）计入该闸机
+UNKNOWN_GATE = "unknown"
+DEFAULT_SITE = "default"
+BASELINE_NAME = "baseline"
+
+
+class PresenceTracker:
+    """按闸机统计在场人数，按设备记录最后心跳时间"""
+
+    def __init__(self, directory="data/presence", stale_after=60, sites=None):
+        self.snapshots = WorkerSnapshots(directory)
+        self.stale_after = stale_after
+        # 设备号 -> 场地
+        self.sites = sites or {}
+        # 当前worker的增量: 闸机 -> 在场人数变化
+        self._occupancy = {}
+        # 当前worker收到的心跳: 设备号 -> 最后心跳时间戳
+        self._last_seen = {}
+        # 后台汇总结果：基线与其他worker的在场人数，所有设备按最后心跳时间排序
+        self._others = {}
+        self._by_seen = []
+        self._seen_at = []
+
+    def entered(self, gate):
+        gate = gate or UNKNOWN_GATE
+        self._occupancy[gate] = self._occupancy.get(gate, 0) + 1
+
+    def left(self, gate):
+        gate = gate or UNKNOWN_GATE
+        self._occupancy[gate] = self._occupancy.get(gate, 0) - 1
+
+    def seen(self, device_no):
+        self._last_seen[device_no] = time.time()
+
+    def clear(self):
+        """主进程启动时清理上次运行的数据"""
+        self.snapshots.clear()
+
+    def write_baseline(self, occupancy, devices):
+        """主进程写入基线：各闸机在场人数与各设备最后活跃时间戳"""
+        self.snapshots.write(
+            {"occupancy": occupancy, "devices": devices}, name=BASELINE_NAME
+        )
+
+    def _snapshot(self):
+        return {"occupancy": dict(self._occupancy), "devices": dict(self._last_seen)}
+
+    def publish(self):
+        """原子写入当前worker的增量"""
+        self.snapshots.write(self._snapshot())
+
+    def restore(self):
+        """worker重启后沿用同名文件中的增量，避免已发生的进出被清零"""
+        data = self.snapshots.read()
+        if data is None:
+            return
+        for gate, count in data.get("occupancy", {}).items():
+            self._occupancy[gate] = self._occupancy.get(gate, 0) + count
+        for device_no, seen_at in data.get("devices", {}).items():
+            if seen_at > self._last_seen.get(device_no, 0):
+                self._last_seen[device_no] = seen_at
+
+    def _collect(self, devices):
+        """读取基线与其他worker的文件，返回 (在场人数, 按心跳时间排序的设备)"""
+        occupancy = {}
+        devices = dict(devices)
+        for data in self.snapshots.read_others():
+            for gate, count in data.get("occupancy", {}).items():
+                occupancy[gate] = occupancy.get(gate, 0) + count
+            for device_no, seen_at in data.get("devices", {}).items():
+                if seen_at > devices.get(device_no, 0):
+                    devices[device_no] = seen_at
+        by_seen = sorted((seen_at, device_no) for device_no, seen_at in devices.items())
+        return occupancy, by_seen
+
+    def _apply(self, collected):
+        self._others, self._by_seen = collected
+        self._seen_at = [seen_at for seen_at, _ in self._by_seen]
+
+    def refresh(self):
+        """同步重建汇总（worker启动时使用）"""
+        self._apply(self._collect(self._last_seen))
+
+    async def sync(self):
+        """写入当前worker的增量并在线程中重建汇总，由后台任务定时调用"""
+        snapshot = self._snapshot()
+        await asyncio.to_thread(self.snapshots.write, snapshot)
+        self._apply(await asyncio.to_thread(self._collect, snapshot["devices"]))
+
+    def occupancy(self):
+        occupancy = dict(self._others)
+        for gate, count in self._occupancy.items():
+            occupancy[gate] = occupancy.get(gate, 0) + count
+
+        sites = {}
+        for gate, count in occupancy.items():
+            site = self.sites.get(gate, DEFAULT_SITE)
+            sites[site] = sites.get(site, 0) + count
+        return {
+            "total": sum(occupancy.values()),
+            "sites": sites,
+            "gates": {gate: count for gate, count in occupancy.items() if count},
+        }
+
+    def stale_devices(self, threshold=None):
+        """最后心跳早于threshold秒前的设备，按心跳时间从早到晚排列
+
+        在汇总中二分查找，排除汇总后当前worker又收到心跳的设备
+        """
+        cutoff = time.time() - (self.stale_after if threshold is None else threshold)
+        count = bisect_left(self._seen_at, cutoff)
+        return [
+            (seen_at, device_no)
+            for seen_at, device_no in self._by_seen[:count]
+            if self._last_seen.get(device_no, 0) < cutoff
+        ]
+
+
+# 进程内单例
+presence_tracker = PresenceTracker(**PRESENCE_CONFIG)
@@ -0,0 +1,64 @@
+"""
+闸机二维码内容解析
+闸机上报的Card为二维码内容的base64编码（可能为URL安全编码，"+"可能被转成空格）：
+一次translate归一化后严格解码（binascii strict_mode，需要 Python 3.11+），只接受进入记录UUID或签名令牌两种格式，
+格式错误的扫码在访问数据库（更新设备、查询进入记录）之前即被拒绝
+"""
+
+import binascii
+from service.qrTokenService import TOKEN_LENGTH, TOKEN_SEPARATOR_INDEX
+
+UUID = "uuid"
+TOKEN = "token"
+
+_UUID_LENGTH = 36
+_UUID_DASHES = b"----"
+_HEX_DIGITS = b"0123456789abcdefABCDEF"
+_BASE64URL_CHARS = b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789-_"
+# 空格与URL安全字符转换为标准base64字符（bytes.translate比str.translate快得多）
+_NORMALIZE = bytes.maketrans(b" -_", b"++/")
+# 最长内容base64编码（含填充）后的长度，超出的不解码
+_MAX_ENCODED_LENGTH = (max(_UUID_LENGTH, TOKEN_LENGTH) + 2) // 3 * 4
+
+
+class QrPayload:
+    """解析后的二维码内容，kind 为 UUID 或 TOKEN，后续按 kind 查找准入状态"""
+
+    __slots__ = ("kind", "value")
+
+    def __init__(self, kind, value):
+        self.kind = kind
+        self.value = value
+
+    @property
+    def is_token(self):
+        return self.kind == TOKEN
+
+
+def parse_qr_payload(card):
+    """解码并校验闸机上报的Card，返回QrPayload，格式错误返回None（由调用方拒绝）"""
+    if not card or len(card) > _MAX_ENCODED_LENGTH:
+        return None
+
+    try:
+        value = card.encode("ascii").translate(_NORMALIZE)
+        if len(value) % 4:
+            value += b"=" * (-len(value) % 4)
+        raw = binascii.a2b_base64(value, strict_mode=True)
+    except (binascii.Error, ValueError):
+        return None
+
+    # 删除合法字符后只应剩下分隔符（UUID的"-"位于8/13/18/23，"." 为46）
+    if len(raw) == _UUID_LENGTH:
+        if (
+            raw.translate(None, _HEX_DIGITS) == _UUID_DASHES
+            and raw[8:24:5] == _UUID_DASHES
+        ):
+            return QrPayload(UUID, raw.decode("ascii"))
+    elif len(raw) == TOKEN_LENGTH:
+        if (
+            raw.translate(None, _BASE64URL_CHARS) == b"."
+            and raw[TOKEN_SEPARATOR_INDEX] == 46
+        ):
+            return QrPayload(TOKEN, raw.decode("ascii"))
+    return None
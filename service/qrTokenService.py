@@ -0,0 +1,88 @@
+"""
+签名二维码令牌
+令牌格式: base64url(版本, 进入记录ID, 用户ID, 订单ID, 过期时间) + "." + base64url(HMAC-SHA256截断)
+闸机扫码时只需CPU即可校验真伪与有效期，伪造或过期的二维码不会产生数据库查询
+"""
+
+import base64
+import hashlib
+import hmac
+import struct
+import time
+from service.admissionService import AdmissionDenied
+
+_VERSION = 1
+_PAYLOAD = struct.Struct(">BIIII")
+_SIGNATURE_SIZE = 12
+# 负载与签名base64url编码（去掉填充）后的长度
+_PAYLOAD_LENGTH = 23
+_SIGNATURE_LENGTH = 16
+TOKEN_LENGTH = _PAYLOAD_LENGTH + 1 + _SIGNATURE_LENGTH
+# 负载与签名之间"."的位置
+TOKEN_SEPARATOR_INDEX = _PAYLOAD_LENGTH
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(value):
+    return base64.urlsafe_b64decode(value + "=" * (-len(value) % 4))
+
+
+class QrToken:
+    """校验通过的令牌内容"""
+
+    __slots__ = ("enter_log_id", "user_id", "order_id", "expire_at")
+
+    def __init__(self, enter_log_id, user_id, order_id, expire_at):
+        self.enter_log_id = enter_log_id
+        self.user_id = user_id
+        self.order_id = order_id
+        self.expire_at = expire_at
+
+
+class QrTokenSigner:
+    """二维码令牌签发与校验"""
+
+    def __init__(self, secret="", ttl=86400, enabled=False):
+        self.enabled = bool(enabled and secret)
+        self.ttl = ttl
+        self._key = secret.encode("utf-8")
+
+    @property
+    def can_verify(self):
+        """配置了密钥即可校验令牌，是否下发令牌由enabled控制"""
+        return bool(self._key)
+
+    def _sign(self, payload):
+        return hmac.new(self._key, payload, hashlib.sha256).digest()[:_SIGNATURE_SIZE]
+
+    def sign(self, enter_log_id, user_id, order_id, expire_at=None):
+        """签发令牌"""
+        if expire_at is None:
+            expire_at = int(time.time() + self.ttl)
+        payload = _PAYLOAD.pack(
+            _VERSION, int(enter_log_id), int(user_id), int(order_id), int(expire_at)
+        )
+        return _b64encode(payload) + "." + _b64encode(self._sign(payload))
+
+    def verify(self, token):
+        """校验令牌签名与有效期，失败抛出AdmissionDenied"""
+        try:
+            payload = _b64decode(token[:_PAYLOAD_LENGTH])
+            signature = _b64decode(token[_PAYLOAD_LENGTH + 1 :])
+            version, enter_log_id, user_id, order_id, expire_at = _PAYLOAD.unpack(
+                payload
+            )
+        except (ValueError, struct.error):
+            raise AdmissionDenied(f"二维码 {token} 格式错误", "token_malformed")
+
+        if version != _VERSION or not hmac.compare_digest(
+            signature, self._sign(payload)
+        ):
+            raise AdmissionDenied(f"二维码 {token} 签名无效", "token_invalid")
+        if expire_at < time.time():
+            raise AdmissionDenied(f"二维码 {token} 已过期", "token_expired")
+
+        return QrToken(enter_log_id, user_id, order_id, expire_at)
@@ -0,0 +1,162 @@
+"""
+付款中订单对账
+支付通知丢失时订单会一直停留在付款中，定时分批查询微信交易状态：
+已支付的交给支付通知队列处理（更新订单并创建入闸二维码），关闭、失败与超时未支付的批量更新状态
+"""
+
+import asyncio
+from datetime import datetime, timedelta
+from loguru import logger
+from models import Order, User
+from service.metricsService import metrics
+
+# 对账结果
+PAID = "paid"
+NOT_PAID = "not_paid"
+WAITING = "waiting"
+FAILED = "failed"
+CANCELLED = "cancelled"
+EXPIRED = "expired"
+
+# 微信交易状态 -> 对账结果
+TRADE_STATES = {
+    "SUCCESS": PAID,
+    "NOTPAY": NOT_PAID,
+    "USERPAYING": WAITING,
+    "CLOSED": CANCELLED,
+    "REVOKED": CANCELLED,
+    "REFUND": CANCELLED,
+    "PAYERROR": FAILED,
+}
+
+
+class PayingOrderReconciler:
+    """
+    query(out_trade_no) / close(out_trade_no): 查询与关闭微信订单的异步函数
+    on_paid(out_trade_no, transaction_id, openid): 已支付订单的处理函数（可重复执行）
+    """
+
+    def __init__(
+        self,
+        query,
+        close,
+        on_paid,
+        min_age=600,
+        expire_after=7200,
+        batch_size=100,
+        concurrency=4,
+    ):
+        self.query = query
+        self.close = close
+        self.on_paid = on_paid
+        self.min_age = min_age
+        self.expire_after = expire_after
+        self.batch_size = batch_size
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    async def _limited(self, func, *args):
+        async with self._semaphore:
+            return await func(*args)
+
+    async def _query(self, order):
+        try:
+            transaction = await self._limited(self.query, order.order_no)
+        except Exception as e:
+            logger.error(f"对账查询订单失败, order_no: {order.order_no}, error: {e}")
+            return order, WAITING, None
+        # 微信侧不存在该订单说明预支付未成功
+        if transaction is None:
+            return order, FAILED, transaction
+        return (
+            order,
+            TRADE_STATES.get(transaction.get("trade_state"), WAITING),
+            transaction,
+        )
+
+    async def _close(self, order):
+        try:
+            await self._limited(self.close, order.order_no)
+            return order.order_no
+        except Exception as e:
+            logger.error(f"对账关闭订单失败, order_no: {order.order_no}, error: {e}")
+            return None
+
+    async def _handle_paid(self, order, transaction):
+        openid = (transaction.get("payer") or {}).get("openid")
+        if not openid:
+            user = await User.get_cached_user(id=order.user_id)
+            openid = user.openid if user else None
+        try:
+            await self.on_paid(
+                order.order_no, transaction.get("transaction_id"), openid
+            )
+        except Exception as e:
+            logger.error(
+                f"对账处理已支付订单失败, order_no: {order.order_no}, error: {e}"
+            )
+
+    async def run_once(self):
+        """处理所有待对账订单，返回各结果的数量"""
+        now = datetime.now()
+        before = (now - timedelta(seconds=self.min_age)).strftime("%Y-%m-%d %H:%M:%S")
+        expire_before = now - timedelta(seconds=self.expire_after)
+        counts = {}
+        after_id = 0
+        while True:
+            orders = await Order.get_stale_paying_orders(
+                before, after_id, self.batch_size
+            )
+            if not orders:
+                break
+            after_id = orders[-1].id
+
+            results = await asyncio.gather(*[self._query(order) for order in orders])
+            failed, cancelled, expired = [], [], []
+            for order, result, transaction in results:
+                if result == PAID:
+                    await self._handle_paid(order, transaction)
+                elif result == FAILED:
+                    failed.append(order.order_no)
+                elif result == CANCELLED:
+                    cancelled.append(order.order_no)
+                # 数据库中为本地时间
+                elif (
+                    result == NOT_PAID
+                    and order.created_at.replace(tzinfo=None) < expire_before
+                ):
+                    expired.append(order)
+                    continue
+                counts[result] = counts.get(result, 0) + 1
+
+            # 超时未支付的订单先在微信侧关闭，避免取消后用户仍能支付
+            closed = await asyncio.gather(*[self._close(order) for order in expired])
+            closed = [order_no for order_no in closed if order_no]
+            if closed:
+                counts[EXPIRED] = counts.get(EXPIRED, 0) + len(closed)
+
+            await Order.update_paying_orders(
+                failed, Order.STATUS_FAILED, "对账: 支付失败"
+            )
+            await Order.update_paying_orders(
+                cancelled, Order.STATUS_CANCELLED, "对账: 订单已关闭"
+            )
+            await Order.update_paying_orders(
+                closed, Order.STATUS_CANCELLED, "对账: 超时未支付，已关闭"
+            )
+            if len(orders) < self.batch_size:
+                break
+
+        for result, count in counts.items():
+            metrics.inc("pay_reconcile_total", (result,), count)
+        return counts
+
+    async def run(self, interval=300):
+        """后台任务：定时对账"""
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                counts = await self.run_once()
+                if counts:
+                    logger.info(f"付款中订单对账完成, 结果: {counts}")
+            except Exception as e:
+                logger.error(f"付款中订单对账失败, error: {e}")
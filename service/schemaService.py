@@ -0,0 +1,82 @@
+"""
+数据表索引检查
+启动时核对热点查询依赖的索引是否存在，缺失时输出告警（迁移脚本见 migrations/）
+"""
+
+# (表名, 索引列（按顺序）, 是否要求唯一)
+EXPECTED_INDEXES = [
+    ("enter_log", ("qrcode",), True),
+    ("enter_log", ("user_id", "order_id", "leave_at"), False),
+    ("devices", ("device_no",), True),
+    ("orders", ("order_no",), True),
+    ("orders", ("user_id", "status", "created_at"), False),
+]
+
+# 可选功能依赖的索引，功能开启时才检查
+FEATURE_INDEXES = {
+    # 进入记录归档按离开时间分批扫描
+    "archive": [("enter_log", ("leave_at",), False)],
+    # 付款中订单对账按状态扫描
+    "reconcile": [("orders", ("status",), False)],
+}
+
+
+def expected_indexes(features=()):
+    """基础索引与已开启功能的索引"""
+    expected = list(EXPECTED_INDEXES)
+    for feature in features:
+        expected.extend(FEATURE_INDEXES.get(feature, []))
+    return expected
+
+
+def find_missing_indexes(existing, expected=EXPECTED_INDEXES):
+    """根据已有索引找出缺失的索引
+
+    existing: [(表名, 索引列元组, 是否唯一)]
+    普通索引允许由前缀匹配的联合索引覆盖，唯一索引要求列完全一致
+    """
+    missing = []
+    for table, columns, unique in expected:
+        covered = any(
+            table == existing_table
+            and (
+                existing_columns == columns and existing_unique
+                if unique
+                else existing_columns[: len(columns)] == columns
+            )
+            for existing_table, existing_columns, existing_unique in existing
+        )
+        if not covered:
+            missing.append((table, columns, unique))
+    return missing
+
+
+async def check_indexes(db, features=()):
+    """查询MySQL的information_schema，返回缺失的索引；非MySQL数据库跳过检查
+
+    features: 已开启的可选功能（见 FEATURE_INDEXES）
+    """
+    if db.capabilities.dialect != "mysql":
+        return []
+
+    expected = expected_indexes(features)
+    tables = sorted({table for table, _, _ in expected})
+    _, rows = await db.execute_query(
+        "SELECT TABLE_NAME, INDEX_NAME, NON_UNIQUE, COLUMN_NAME "
+        "FROM information_schema.STATISTICS "
+        "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME IN ("
+        + ", ".join(["%s"] * len(tables))
+        + ") ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX",
+        tables,
+    )
+
+    indexes = {}
+    for row in rows:
+        key = (row["TABLE_NAME"], row["INDEX_NAME"])
+        columns, _ = indexes.get(key, ((), False))
+        indexes[key] = (columns + (row["COLUMN_NAME"],), not row["NON_UNIQUE"])
+
+    existing = [
+        (table, columns, unique) for (table, _), (columns, unique) in indexes.items()
+    ]
+    return find_missing_indexes(existing, expected)
@@ -0,0 +1,99 @@
+"""
+小程序session_key存储
+- memory: 进程内LRU缓存，仅适用于单进程运行
+- sqlite: 本地SQLite文件，多个worker进程共享
+"""
+
+import time
+from tool import connectSqlite
+from service.cacheService import TTLCache
+
+
+class MemorySessionStore:
+    """进程内session_key存储"""
+
+    def __init__(self, ttl=1800, maxsize=10000):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def get(self, openid):
+        return self._cache.get(openid)
+
+    def set(self, openid, session_key):
+        self._cache.set(openid, session_key)
+
+    def pop(self, openid):
+        return self._cache.pop(openid)
+
+
+class SqliteSessionStore:
+    """基于本地SQLite文件的session_key存储，按过期时间与最近使用时间淘汰"""
+
+    # 每写入多少次清理一次过期与超量记录
+    PRUNE_EVERY = 100
+
+    def __init__(self, path, ttl=1800, maxsize=10000):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._writes = 0
+        self._conn = connectSqlite(path)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS session_keys ("
+            "openid TEXT PRIMARY KEY, "
+            "session_key TEXT NOT NULL, "
+            "expire_at REAL NOT NULL, "
+            "used_at REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_session_keys_used_at ON session_keys (used_at)"
+        )
+
+    def get(self, openid):
+        now = time.time()
+        row = self._conn.execute(
+            "SELECT session_key FROM session_keys WHERE openid = ? AND expire_at > ?",
+            (openid, now),
+        ).fetchone()
+        if row is None:
+            return None
+        self._conn.execute(
+            "UPDATE session_keys SET used_at = ? WHERE openid = ?", (now, openid)
+        )
+        return row[0]
+
+    def set(self, openid, session_key):
+        now = time.time()
+        self._conn.execute(
+            "INSERT OR REPLACE INTO session_keys (openid, session_key, expire_at, used_at) "
+            "VALUES (?, ?, ?, ?)",
+            (openid, session_key, now + self.ttl, now),
+        )
+        self._writes += 1
+        if self._writes % self.PRUNE_EVERY == 0:
+            self.prune()
+
+    def pop(self, openid):
+        session_key = self.get(openid)
+        self._conn.execute("DELETE FROM session_keys WHERE openid = ?", (openid,))
+        return session_key
+
+    def prune(self):
+        """删除过期记录，超出容量时淘汰最久未使用的记录"""
+        self._conn.execute(
+            "DELETE FROM session_keys WHERE expire_at <= ?", (time.time(),)
+        )
+        self._conn.execute(
+            "DELETE FROM session_keys WHERE openid IN ("
+            "SELECT openid FROM session_keys ORDER BY used_at DESC LIMIT -1 OFFSET ?)",
+            (self.maxsize,),
+        )
+
+
+def create_session_store(
+    backend="sqlite", path="data/session.db", ttl=1800, maxsize=10000
+):
+    """根据配置创建session_key存储"""
+    if backend == "memory":
+        return MemorySessionStore(ttl=ttl, maxsize=maxsize)
+    if backend == "sqlite":
+        return SqliteSessionStore(path, ttl=ttl, maxsize=maxsize)
+    raise ValueError(f"不支持的session存储类型: {backend}")
@@ -0,0 +1,78 @@
+"""
+闸机限流与降载
+按设备号（Serial）令牌桶限流，防止单台异常闸机刷接口；
+数据库相关操作全局限制并发，扫码排队等待，心跳在繁忙时直接由内存应答不访问数据库
+"""
+
+import asyncio
+import time
+from collections import OrderedDict
+from config import GATE_THROTTLE_CONFIG
+
+
+class TokenBucketLimiter:
+    """按key的令牌桶，rate为每秒补充令牌数，burst为桶容量"""
+
+    def __init__(self, rate, burst, maxsize=10000):
+        self.rate = rate
+        self.burst = burst
+        self.maxsize = maxsize
+        # key -> [剩余令牌, 上次补充时间]
+        self._buckets = OrderedDict()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def allow(self, key):
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = [self.burst, now]
+            # 超出容量时淘汰最久未请求的设备
+            while len(self._buckets) > self.maxsize:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+        if bucket[0] < 1:
+            return False
+        bucket[0] -= 1
+        return True
+
+
+class GateThrottle:
+    """闸机接口的设备限流与数据库并发控制"""
+
+    def __init__(
+        self,
+        heartbeat_rate=1.0,
+        heartbeat_burst=5,
+        scan_rate=5.0,
+        scan_burst=20,
+        db_concurrency=20,
+        maxsize=10000,
+    ):
+        self.heartbeats = TokenBucketLimiter(heartbeat_rate, heartbeat_burst, maxsize)
+        self.scans = TokenBucketLimiter(scan_rate, scan_burst, maxsize)
+        self._db_slots = asyncio.Semaphore(db_concurrency)
+
+    def allow_heartbeat(self, serial):
+        return self.heartbeats.allow(serial)
+
+    def allow_scan(self, serial):
+        return self.scans.allow(serial)
+
+    @property
+    def busy(self):
+        """没有空闲的数据库并发额度，或已有扫码在排队"""
+        return self._db_slots.locked()
+
+    def db_slot(self):
+        """数据库并发额度，扫码使用时排队等待；心跳应先判断busy，繁忙时不进入"""
+        return self._db_slots
+
+
+# 进程内单例
+gate_throttle = GateThrottle(**GATE_THROTTLE_CONFIG)
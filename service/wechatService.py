@@ -1,19 +1,102 @@
 import os
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 from dotenv import load_dotenv
 from wechatpayv3 import WeChatPay, WeChatPayType
+from wechatpayv3.utils import aes_decrypt, load_certificate
+from datetime import datetime, timezone
+from loguru import logger
 import json
 import time
 import random
 import string
-import requests
+import httpx
 import base64
 from Crypto.Cipher import AES
+from config import WECHAT_CONFIG, WECHAT_PAY_CONFIG, SESSION_CONFIG
+from service.sessionService import create_session_store
+from service.metricsService import timer
 
 # 加载环境变量
 load_dotenv()
 
-# 简单的内存缓存
-_session_cache = {}
+# session_key存储，首次使用时按配置创建
+_session_cache = None
+
+
+def _get_session_cache():
+    global _session_cache
+    if _session_cache is None:
+        _session_cache = create_session_store(**SESSION_CONFIG)
+    return _session_cache
+
+
+class weChatClient:
+    """
+    微信异步HTTP客户端
+    复用长连接池，限制超时与并发；无法走异步HTTP的同步调用（如wechatpayv3）放入有界线程池执行
+    """
+
+    def __init__(
+        self, timeout=5.0, max_connections=50, max_concurrency=20, thread_pool_size=8
+    ):
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.max_concurrency = max_concurrency
+        self.thread_pool_size = thread_pool_size
+        self._client = None
+        self._executor = None
+        self._semaphore = None
+
+    async def start(self):
+        """随应用启动创建连接池与线程池"""
+        self._client = httpx.AsyncClient(
+            timeout=httpx.Timeout(self.timeout),
+            limits=httpx.Limits(
+                max_connections=self.max_connections,
+                max_keepalive_connections=self.max_connections,
+            ),
+        )
+        self._executor = ThreadPoolExecutor(
+            max_workers=self.thread_pool_size, thread_name_prefix="wechat"
+        )
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+    async def close(self):
+        """随应用停止释放连接池与线程池"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+            self._executor = None
+
+    async def get_json(self, url, params=None, timeout=None, call="get"):
+        """异步GET请求并解析JSON，call为统计耗时使用的调用名"""
+        with timer("wechat_call_duration_seconds", call):
+            async with self._semaphore:
+                response = await self._client.get(
+                    url, params=params, timeout=timeout or self.timeout
+                )
+            return response.json()
+
+    async def run_sync(self, func, *args, timeout=None, call=None, **kwargs):
+        """在有界线程池中执行同步调用，避免阻塞事件循环"""
+        loop = asyncio.get_running_loop()
+        with timer("wechat_call_duration_seconds", call or func.__qualname__):
+            async with self._semaphore:
+                return await asyncio.wait_for(
+                    loop.run_in_executor(
+                        self._executor, partial(func, *args, **kwargs)
+                    ),
+                    timeout or self.timeout,
+                )
+
+
+# 进程内单例，由应用生命周期启动和关闭
+wechat_client = weChatClient(**WECHAT_CONFIG)
 
 
 class weChatPay:
@@ -23,6 +106,21 @@ class weChatPay:
     - 支付: https://pay.weixin.qq.com/wiki/doc/apiv3/apis/chapter3_5_1.shtml
     """
 
+    # 进程内共享实例
+    _instance = None
+    _instance_lock = threading.Lock()
+    # 平台证书下载与替换互斥
+    _certificates_lock = threading.Lock()
+
+    @classmethod
+    def instance(cls):
+        """获取共享的支付客户端，密钥与平台证书只在首次创建时加载"""
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+
     # 初始化微信支付
     def __init__(self):
         self.wxpay = WeChatPay(
@@ -33,7 +131,10 @@ class weChatPay:
             wechatpay_type=WeChatPayType.MINIPROG,
             cert_serial_no=os.getenv("CERT_SERIAL_NO"),
             apiv3_key=os.getenv("API_V3_KEY"),
+            timeout=WECHAT_CONFIG["timeout"],
         )
+        # 验签遇到未知证书序列号时SDK会先清空证书列表再下载，替换为下载成功后整体替换
+        self.wxpay._core._update_certificates = self._update_certificates
 
     # 支付
     def prepay(self, order, openid):
@@ -73,6 +174,80 @@ class weChatPay:
         """验证支付通知签名"""
         return self.wxpay.callback(headers, body)
 
+    def query_order(self, out_trade_no):
+        """按商户订单号查询交易，微信侧不存在该订单时返回None"""
+        http_code, http_result = self.wxpay.query(out_trade_no=out_trade_no)
+        if http_code == 404:
+            return None
+        if http_code != 200:
+            raise Exception(
+                f"查询订单状态码异常, http_code: {http_code}, result: {http_result}"
+            )
+        return json.loads(http_result)
+
+    def close_order(self, out_trade_no):
+        """关闭未支付的订单，关闭后用户无法再支付"""
+        http_code, http_result = self.wxpay.close(out_trade_no=out_trade_no)
+        if http_code != 204:
+            raise Exception(
+                f"关闭订单状态码异常, http_code: {http_code}, result: {http_result}"
+            )
+
+    def refresh_certificates(self):
+        """重新下载微信支付平台证书，下载成功后整体替换证书列表，失败时保留原证书
+
+        验签在线程池中并发读取证书列表，不能原地清空后再下载
+        """
+        core = self.wxpay._core
+        with self._certificates_lock:
+            code, message = core.request("/v3/certificates", skip_verify=True)
+            if code != 200:
+                raise Exception(
+                    f"下载平台证书状态码异常, http_code: {code}, result: {message}"
+                )
+
+            certificates = []
+            now = datetime.now(timezone.utc)
+            for value in json.loads(message).get("data") or []:
+                encrypted = value.get("encrypt_certificate") or {}
+                cert_str = aes_decrypt(
+                    nonce=encrypted.get("nonce"),
+                    ciphertext=encrypted.get("ciphertext"),
+                    associated_data=encrypted.get("associated_data"),
+                    apiv3_key=core._apiv3_key,
+                )
+                certificate = load_certificate(cert_str)
+                if not certificate or not (
+                    certificate.not_valid_before_utc
+                    <= now
+                    <= certificate.not_valid_after_utc
+                ):
+                    continue
+                certificates.append(certificate)
+                self._save_certificate(core._cert_dir, value.get("serial_no"), cert_str)
+
+            if not certificates:
+                raise Exception("下载的平台证书均无效，保留原证书")
+            core._certificates = certificates
+
+    def _update_certificates(self):
+        """SDK验签时按需刷新证书，失败时保留原证书继续验签"""
+        try:
+            self.refresh_certificates()
+        except Exception as e:
+            logger.error(f"微信支付平台证书刷新失败, error: {e}")
+
+    @staticmethod
+    def _save_certificate(cert_dir, serial_no, cert_str):
+        """与SDK一致，将证书保存到证书目录，重启时直接加载"""
+        if not cert_dir or not serial_no:
+            return
+        path = os.path.join(cert_dir, f"{serial_no}.pem")
+        if not os.path.exists(path):
+            os.makedirs(cert_dir, exist_ok=True)
+            with open(path, "w") as f:
+                f.write(cert_str)
+
     def _generate_payment_params(self, prepay_id):
         """生成小程序支付参数"""
 
@@ -106,19 +281,61 @@ class weChatPay:
             return f.read()
 
 
+class MockWeChatPay:
+    """
+    本地模拟的微信订单查询与关闭，只供付款中订单对账使用，不访问微信接口
+    订单交易状态从JSON文件读取: {"订单号": {"trade_state": "SUCCESS", "transaction_id": "...", "payer": {"openid": "..."}}}
+    文件中没有的订单视为 NOTPAY，trade_state 为 ORDER_NOT_EXIST 时模拟微信侧不存在该订单
+    """
+
+    def __init__(self, mock_file="data/wechat_mock.json"):
+        self.mock_file = mock_file
+
+    def _load(self):
+        try:
+            with open(self.mock_file) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def query_order(self, out_trade_no):
+        transaction = self._load().get(out_trade_no, {"trade_state": "NOTPAY"})
+        if transaction.get("trade_state") == "ORDER_NOT_EXIST":
+            return None
+        return {"out_trade_no": out_trade_no, **transaction}
+
+    def close_order(self, out_trade_no):
+        pass
+
+
+def trade_client():
+    """对账查询与关闭订单使用的客户端
+
+    配置 WECHAT_MOCK=true 时使用本地模拟的交易状态；支付下单与支付通知验签始终使用真实客户端
+    """
+    if WECHAT_PAY_CONFIG["mock"]:
+        return MockWeChatPay(WECHAT_PAY_CONFIG["mock_file"])
+    return weChatPay.instance()
+
+
 class weChatTool:
     """
     微信工具类
     """
 
     # 通过小程序登录凭证code获取用户的openid
-    def get_openid(self, code):
+    async def get_openid(self, code):
         try:
-            appid = os.getenv("APPID")
-            secret = os.getenv("SECRET")
-            url = f"https://api.weixin.qq.com/sns/jscode2session?appid={appid}&secret={secret}&js_code={code}&grant_type=authorization_code"
-            response = requests.get(url)
-            data = response.json()
+            url = "https://api.weixin.qq.com/sns/jscode2session"
+            params = {
+                "appid": os.getenv("APPID"),
+                "secret": os.getenv("SECRET"),
+                "js_code": code,
+                "grant_type": "authorization_code",
+            }
+            data = await wechat_client.get_json(
+                url, params=params, call="jscode2session"
+            )
         except Exception as e:
             raise Exception(f"解密code异常, error: {e}")
 
@@ -127,14 +344,14 @@ class weChatTool:
         if not openid or not session_key:
             raise Exception(f"没有返回openid或session_key {data}")
 
-        _session_cache[openid] = session_key
+        _get_session_cache().set(openid, session_key)
 
         return openid
 
     @property
     def session_cache(self):
         """获取session缓存"""
-        return _session_cache
+        return _get_session_cache()
 
     # 解密手机号
     def decrypt_data_get_phone(self, session_key, encrypted_data, iv):
@@ -0,0 +1,71 @@
+"""
+worker进程标识与共享快照文件
+Sanic多worker运行时各worker进程名形如 Sanic-Server-0-0（重启后不变），单进程运行时没有进程名；
+各worker定时将内存数据写入共享目录下以worker命名的JSON文件，读取时汇总所有worker
+"""
+
+import glob
+import json
+import os
+import re
+
+
+def get_worker_name():
+    """Sanic worker进程名，单进程运行时为None"""
+    return os.getenv("SANIC_WORKER_NAME") or None
+
+
+def get_worker_id():
+    """worker进程名，单进程运行时使用进程号"""
+    return get_worker_name() or str(os.getpid())
+
+
+def get_worker_index():
+    """Sanic worker进程名形如 Sanic-Server-0-0，第一个数字为worker序号"""
+    match = re.match(r"^Sanic-Server-(\d+)", get_worker_name() or "")
+    return int(match.group(1)) if match else 0
+
+
+class WorkerSnapshots:
+    """共享目录下各worker的JSON快照文件"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.worker = get_worker_id()
+
+    def path(self, name=None):
+        return os.path.join(self.directory, f"{name or self.worker}.json")
+
+    def clear(self):
+        """主进程启动时清理上次运行的快照"""
+        for path in glob.glob(os.path.join(self.directory, "*.json")):
+            os.remove(path)
+
+    def write(self, data, name=None):
+        """原子写入快照，默认写入当前worker的文件"""
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(name)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+
+    def read(self, name=None):
+        """读取快照，文件不存在或正在写入时返回None"""
+        try:
+            with open(self.path(name)) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def read_others(self):
+        """读取除当前worker外的所有快照（包括主进程写入的基线）"""
+        own_path = self.path()
+        for path in glob.glob(os.path.join(self.directory, "*.json")):
+            if path == own_path:
+                continue
+            try:
+                with open(path) as f:
+                    yield json.load(f)
+            except (OSError, ValueError):
+                continue
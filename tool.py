@@ -1,19 +1,42 @@
-import base64
+import os
+import sqlite3
+import time
+from contextvars import ContextVar
 from datetime import datetime
 
-def decodeBase64(value):
-    value = value.replace(" ", "+")
-    value = value.replace("-", "+").replace("_", "/")
-    ln = (len(value) % 4) & 0xFF
-    if ln == 2:
-        value += "=="
-    if ln == 3:
-        value += "="
-    value = base64.b64decode(value)
-    return value
+# 请求开始时间，同一请求内的写入使用同一时间
+_request_time = ContextVar("request_time", default=None)
+# 当前秒与对应的datetime，同一秒内复用
+_second_cache = [None, None]
+
+
+def _currentSecond():
+    second = int(time.time())
+    if second != _second_cache[0]:
+        _second_cache[1] = datetime.fromtimestamp(second)
+        _second_cache[0] = second
+    return _second_cache[1]
 
 
 def getNowTime():
-    # 获取当前时间
-    now = datetime.now()
-    return now.strftime("%Y-%m-%d %H:%M:%S")
+    # 获取当前时间（秒精度的datetime），请求内固定为请求开始时间
+    now = _request_time.get()
+    return now if now is not None else _currentSecond()
+
+
+def startRequestClock():
+    # 请求开始时固定当前时间
+    _request_time.set(_currentSecond())
+
+
+def connectSqlite(path, synchronous="NORMAL"):
+    # 打开本地SQLite文件，WAL模式支持多个worker进程并发读写
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    conn = sqlite3.connect(
+        path, timeout=5, isolation_level=None, check_same_thread=False
+    )
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA synchronous={synchronous}")
+    return conn